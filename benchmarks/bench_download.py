@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import platform
+import tempfile
+import statistics
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from core import (
+    DEFAULT_COOKIES,
+    DEFAULT_HEADERS,
+    HttpClient,
+    resolve_page,
+    fetch_video_data,
+    quality_options,
+    pick_quality,
+    create_downloader,
+    output_filename,
+    iter_listing,
+)
+from media_server import MediaServer
+
+SCENARIOS = ("resolve", "listing", "single", "batch")
+# Metric checked against a baseline, and whether higher is better
+KEY_METRICS = {
+    "resolve": ("median_ms", False),
+    "listing": ("median_ms", False),
+    "single": ("median_mb_per_s", True),
+    "batch": ("wall_seconds", False),
+}
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return usage // 1024 if platform.system() == "Darwin" else usage
+
+def new_client(max_per_host=16):
+    return HttpClient(DEFAULT_HEADERS, DEFAULT_COOKIES, max_per_host=max_per_host)
+
+def time_to_quality_list(client, page_url):
+    # What FindWorker and VideoDataWorker do before the quality list shows up
+    media_definitions, video_title, last_media_url, cover_image_url = resolve_page(client, page_url)
+    video_data = fetch_video_data(client, last_media_url)
+    return quality_options(video_data, media_definitions)
+
+def bench_resolve(base_url, options):
+    client = new_client()
+    timings = []
+    try:
+        for index in range(options["repeat"]):
+            started = time.perf_counter()
+            if not time_to_quality_list(client, f"{base_url}/view_video.php?viewkey=resolve{index}"):
+                raise RuntimeError("No quality options resolved.")
+            timings.append((time.perf_counter() - started) * 1000)
+    finally:
+        client.close()
+    return {
+        "runs": len(timings),
+        "min_ms": round(min(timings), 2),
+        "median_ms": round(statistics.median(timings), 2),
+        "max_ms": round(max(timings), 2),
+    }
+
+def bench_listing(base_url, options):
+    # Time until the first video is known, and until the whole paginated listing is expanded
+    client = new_client()
+    first_timings = []
+    timings = []
+    try:
+        for index in range(options["repeat"]):
+            started = time.perf_counter()
+            videos = set()
+            for video_url in iter_listing(client, f"{base_url}/model/bench{index}/videos"):
+                if not videos:
+                    first_timings.append((time.perf_counter() - started) * 1000)
+                videos.add(video_url)
+            timings.append((time.perf_counter() - started) * 1000)
+    finally:
+        client.close()
+    return {
+        "runs": len(timings),
+        "videos": len(videos),
+        "median_first_ms": round(statistics.median(first_timings), 2),
+        "median_ms": round(statistics.median(timings), 2),
+    }
+
+def bench_single(base_url, options):
+    client = new_client()
+    output_dir = tempfile.mkdtemp(prefix="bench-single-")
+    rates = []
+    try:
+        for index in range(options["repeat"]):
+            filename = os.path.join(output_dir, f"single{index}.mp4")
+            started = time.perf_counter()
+            filename = create_downloader(
+                f"{base_url}/media/single{index}/1080.mp4", client, filename, options["segments"]
+            ).run()
+            elapsed = time.perf_counter() - started
+            size = os.path.getsize(filename)
+            rates.append(size / elapsed / (1024 * 1024))
+            os.remove(filename)
+    finally:
+        client.close()
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {
+        "runs": len(rates),
+        "bytes": size,
+        "segments": options["segments"],
+        "best_mb_per_s": round(max(rates), 2),
+        "median_mb_per_s": round(statistics.median(rates), 2),
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+def download_item(client, page_url, output_dir, segments):
+    media_definitions, video_title, last_media_url, cover_image_url = resolve_page(client, page_url)
+    video_data = fetch_video_data(client, last_media_url)
+    quality, video_url = pick_quality(quality_options(video_data, media_definitions))
+    filename = output_filename(video_title, quality, output_dir)
+    return os.path.getsize(create_downloader(video_url, client, filename, segments).run())
+
+def bench_batch(base_url, options):
+    concurrency = options["concurrency"]
+    client = new_client(max_per_host=concurrency * (options["segments"] + 1))
+    output_dir = tempfile.mkdtemp(prefix="bench-batch-")
+    rss_before = peak_rss_kb()
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            sizes = list(executor.map(
+                lambda index: download_item(
+                    client, f"{base_url}/view_video.php?viewkey=batch{index}", output_dir, options["segments"]
+                ),
+                range(options["items"]),
+            ))
+        elapsed = time.perf_counter() - started
+    finally:
+        client.close()
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {
+        "items": len(sizes),
+        "concurrency": concurrency,
+        "bytes": sum(sizes),
+        "wall_seconds": round(elapsed, 3),
+        "mb_per_s": round(sum(sizes) / elapsed / (1024 * 1024), 2),
+        "peak_rss_kb": peak_rss_kb(),
+        "rss_growth_kb": peak_rss_kb() - rss_before,
+    }
+
+def run_scenario(name, base_url, options):
+    scenarios = {"resolve": bench_resolve, "listing": bench_listing, "single": bench_single, "batch": bench_batch}
+    return scenarios[name](base_url, options)
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, (metric, higher_is_better) in KEY_METRICS.items():
+        if name not in results or name not in baseline.get("scenarios", {}):
+            continue
+        current = results[name][metric]
+        previous = baseline["scenarios"][name][metric]
+        if higher_is_better:
+            regressed = current < previous * (1 - tolerance)
+        else:
+            regressed = current > previous * (1 + tolerance)
+        if regressed:
+            regressions.append(f"{name}.{metric}: {previous} -> {current}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark resolve and download paths against a local media server.")
+    parser.add_argument("scenarios", nargs="*", help=f"Any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds the server waits before every response")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Bytes per second per connection, 0 for unlimited")
+    parser.add_argument("--video-size", type=int, default=32 * 1024 * 1024)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--items", type=int, default=20, help="Items in the batch scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="Items downloaded at once in the batch scenario")
+    parser.add_argument("-o", "--output", help="Write the JSON results here as well as to stdout")
+    parser.add_argument("--baseline", help="Earlier JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative slowdown before failing")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(sorted(unknown))}")
+
+    options = {
+        "repeat": max(1, args.repeat),
+        "segments": max(1, args.segments),
+        "items": max(1, args.items),
+        "concurrency": max(1, args.concurrency),
+    }
+    server = MediaServer(latency=args.latency, bandwidth=args.bandwidth, video_size=args.video_size).start()
+    results = {}
+    try:
+        for name in args.scenarios or SCENARIOS:
+            # A fresh process per scenario so peak RSS belongs to that scenario alone
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results[name] = executor.submit(run_scenario, name, server.base_url, options).result()
+            print(f"{name}: {json.dumps(results[name])}", file=sys.stderr)
+    finally:
+        server.stop()
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "server": {"latency": args.latency, "bandwidth": args.bandwidth, "video_size": args.video_size},
+        "options": options,
+        "scenarios": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+import os
+import sys
+import glob
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import WatchPageScanner, parse_watch_page, PAGE_CHUNK_SIZE, HTML_PARSER
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def scan_fast(html_text):
+    scanner = WatchPageScanner()
+    for start in range(0, len(html_text), PAGE_CHUNK_SIZE):
+        if scanner.feed(html_text[start:start + PAGE_CHUNK_SIZE]):
+            break
+    return scanner
+
+def best_time(function, argument, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the fast watch page scanner with the BeautifulSoup parse.")
+    parser.add_argument("pages", nargs="*", help="Saved watch pages (default: benchmarks/fixtures/*.html)")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    pages = args.pages or sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html")))
+    if not pages:
+        print("No fixture pages found.")
+        return 1
+
+    print(f"BeautifulSoup parser: {HTML_PARSER}")
+    for page in pages:
+        with open(page, "r", encoding="utf-8") as page_file:
+            html_text = page_file.read()
+
+        scanner = scan_fast(html_text)
+        if not scanner.complete():
+            print(f"{os.path.basename(page)}: fast path missed, falls back to BeautifulSoup")
+        elif scanner.flashvars_text != parse_watch_page(html_text)[0]:
+            print(f"{os.path.basename(page)}: fast path and BeautifulSoup disagree")
+            return 1
+
+        soup_time = best_time(parse_watch_page, html_text, args.repeat)
+        fast_time = best_time(scan_fast, html_text, args.repeat)
+        print(
+            f"{os.path.basename(page)} ({len(html_text) // 1024} KB, read {len(scanner.buffer) // 1024} KB): "
+            f"soup {soup_time * 1000:.2f} ms, fast {fast_time * 1000:.2f} ms, "
+            f"{soup_time / fast_time:.1f}x"
+        )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
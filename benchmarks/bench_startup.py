@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from core import CACHE_DIR, SessionStore
+
+APP = os.path.join(ROOT_DIR, "pornhub.py")
+# Same variable pornhub.py checks before printing its start-up marks
+STARTUP_TRACE_ENV = "PORNLAND_STARTUP_TRACE"
+MARKS = ("shown", "first_paint", "interactive")
+# Metrics checked against a baseline, lower is better for all of them
+KEY_METRICS = ("median_first_paint_ms", "median_interactive_ms")
+
+def seed_session(work_dir, items):
+    # Finished rows come back from the session without touching the network
+    session = SessionStore(os.path.join(work_dir, CACHE_DIR, "session.sqlite3"))
+    for index in range(items):
+        item_id = session.add(f"http://127.0.0.1:9/view_video.php?viewkey=startup{index}")
+        session.update(item_id, title=f"Start-up video {index}", quality="720", state="finished",
+                       status="Status: Download complete")
+    session.close()
+
+def launch(work_dir, env, timeout):
+    # Marks are CLOCK_MONOTONIC readings, comparable across processes on the same machine
+    started = time.monotonic()
+    result = subprocess.run(
+        [sys.executable, APP], cwd=work_dir, env=env, capture_output=True, text=True, timeout=timeout
+    )
+    lines = [line for line in result.stdout.splitlines() if line.startswith("{")]
+    if result.returncode != 0 or not lines:
+        raise RuntimeError(f"pornhub.py exited with {result.returncode}: {result.stderr.strip()[-500:]}")
+    marks = json.loads(lines[-1])
+    return {name: (marks[name] - started) * 1000 for name in MARKS}
+
+def bench_startup(options):
+    env = dict(os.environ, **{STARTUP_TRACE_ENV: "1"})
+    if options["platform"]:
+        env["QT_QPA_PLATFORM"] = options["platform"]
+    timings = {name: [] for name in MARKS}
+    for index in range(options["warmup"] + options["repeat"]):
+        # A fresh working directory each run, so caches and the session start out the same
+        work_dir = tempfile.mkdtemp(prefix="bench-startup-")
+        try:
+            if options["restore"]:
+                seed_session(work_dir, options["restore"])
+            run = launch(work_dir, env, options["timeout"])
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if index >= options["warmup"]:
+            for name in MARKS:
+                timings[name].append(run[name])
+    results = {"runs": options["repeat"], "restored_items": options["restore"]}
+    for name in MARKS:
+        results[f"min_{name}_ms"] = round(min(timings[name]), 2)
+        results[f"median_{name}_ms"] = round(statistics.median(timings[name]), 2)
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for metric in KEY_METRICS:
+        previous = baseline.get("startup", {}).get(metric)
+        if previous is None:
+            continue
+        if results[metric] > previous * (1 + tolerance):
+            regressions.append(f"startup.{metric}: {previous} -> {results[metric]}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the GUI from launch to first paint and to interactive.")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1, help="Launches run first and left out of the results")
+    parser.add_argument("--restore", type=int, default=0, help="Finished items seeded into the saved session")
+    parser.add_argument("--platform", help="Qt platform plugin, offscreen runs without a display")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds one launch may take")
+    parser.add_argument("-o", "--output", help="Write the JSON results here as well as to stdout")
+    parser.add_argument("--baseline", help="Earlier JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative slowdown before failing")
+    args = parser.parse_args()
+
+    options = {
+        "repeat": max(1, args.repeat),
+        "warmup": max(0, args.warmup),
+        "restore": max(0, args.restore),
+        "platform": args.platform,
+        "timeout": args.timeout,
+    }
+    results = bench_startup(options)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "qt_platform": args.platform or os.environ.get("QT_QPA_PLATFORM", "default"),
+        "startup": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
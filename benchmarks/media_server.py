@@ -0,0 +1,208 @@
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PATTERN_SIZE = 1024 * 1024
+WRITE_SIZE = 64 * 1024
+QUALITIES = ("240", "480", "720", "1080")
+
+def make_pattern(size=PATTERN_SIZE):
+    # Cheap deterministic filler, the bodies repeat it instead of living in memory
+    return bytes((index * 131 + (index >> 8)) & 0xFF for index in range(size))
+
+def make_watch_page(base_url, viewkey, padding):
+    media_definitions = [
+        {"format": "mp4", "videoUrl": f"{base_url}/video/get_media?viewkey={viewkey}", "quality": [], "remote": True},
+    ]
+    flashvars = json.dumps({"mediaDefinitions": media_definitions, "video_title": viewkey}).replace("/", "\\/")
+    # Push #player down the page the way the real markup does
+    filler = "".join(
+        f'<link rel="preload" href="{base_url}/static/bundle-{index}.css" as="style">\n'
+        for index in range(padding // 80)
+    )
+    return (
+        "<!DOCTYPE html>\n<html lang=\"en\">\n<head>\n<meta charset=\"utf-8\">\n"
+        f"<title>Bench {viewkey}</title>\n{filler}</head>\n<body>\n"
+        "<div class=\"video-wrapper\">\n<div id=\"player\" class=\"playerWrapper\">\n"
+        f"<img src=\"{base_url}/cover/{viewkey}.jpg\" alt=\"cover\">\n"
+        f"<script type=\"text/javascript\">var flashvars_1 = {flashvars};</script>\n</div>\n"
+        f"<h1 class=\"title\"><span class=\"inlineFree\">Bench &amp; video {viewkey}</span></h1>\n"
+        "</div>\n</body>\n</html>\n"
+    )
+
+def make_listing_page(base_url, path, page, pages, per_page):
+    # Video tiles like a playlist or model page, a sidebar link repeated on every page, and a window of page links
+    name = path.strip("/").replace("/", "-")
+    tiles = "".join(
+        f'<li class="videoBox"><a href="/view_video.php?viewkey={name}{index}&amp;pkey=1" title="Video {index}">'
+        f'<img src="{base_url}/cover/{name}{index}.jpg"></a></li>\n'
+        for index in range((page - 1) * per_page, page * per_page)
+    )
+    numbers = range(max(1, page - 2), min(pages, page + 2) + 1)
+    pagination = "".join(f'<li class="page_number"><a href="{path}?page={number}">{number}</a></li>' for number in numbers)
+    return (
+        "<!DOCTYPE html>\n<html lang=\"en\">\n<head>\n<meta charset=\"utf-8\">\n"
+        f"<title>Bench listing {name} page {page}</title>\n</head>\n<body>\n"
+        f"<ul class=\"videos\">\n{tiles}</ul>\n"
+        f"<div class=\"sidebar\"><a href=\"/view_video.php?viewkey={name}0\">Top video</a></div>\n"
+        f"<ul class=\"pagination\">{pagination}</ul>\n</body>\n</html>\n"
+    )
+
+class MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, Nagle would stall the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+
+        path, _, query = self.path.partition("?")
+        if path.startswith("/view_video.php"):
+            viewkey = query.partition("viewkey=")[2] or "bench"
+            page = make_watch_page(server.base_url, viewkey, server.page_padding)
+            self.send_body(200, page.encode("utf-8"), "text/html; charset=utf-8")
+        elif path == "/video/get_media":
+            viewkey = query.partition("viewkey=")[2] or "bench"
+            video_data = [
+                {"quality": quality, "videoUrl": f"{server.base_url}/media/{viewkey}/{quality}.mp4", "format": "mp4"}
+                for quality in QUALITIES
+            ]
+            self.send_body(200, json.dumps(video_data).encode("utf-8"), "application/json")
+        elif path.startswith("/cover/"):
+            self.send_body(200, server.pattern[:server.cover_size], "image/jpeg")
+        elif path.startswith("/media/"):
+            self.send_media()
+        elif path.startswith(("/playlist/", "/model/", "/channels/", "/users/", "/pornstar/")):
+            page = query.partition("page=")[2].partition("&")[0]
+            page = int(page) if page.isdigit() else 1
+            if page > server.listing_pages:
+                self.send_body(404, b"Not found", "text/plain")
+            else:
+                listing = make_listing_page(server.base_url, path, page, server.listing_pages, server.listing_size)
+                self.send_body(200, listing.encode("utf-8"), "text/html; charset=utf-8")
+        else:
+            self.send_body(404, b"Not found", "text/plain")
+
+    def send_body(self, status, body, content_type, headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.write_throttled(memoryview(body), 0, len(body))
+
+    def send_media(self):
+        size = self.server.video_size
+        headers = [("Accept-Ranges", "bytes"), ("ETag", f'"bench-{size}"')]
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        match = re.match(r"bytes=(\d+)-(\d*)$", range_header or "")
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            headers.append(("Content-Range", f"bytes {start}-{end}/{size}"))
+
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(end - start + 1))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.write_throttled(memoryview(self.server.pattern), start, end + 1)
+
+    def write_throttled(self, source, start, stop):
+        # Bodies longer than source wrap around it, bandwidth is per connection
+        bandwidth = self.server.bandwidth
+        started = time.monotonic()
+        sent = 0
+        position = start
+        try:
+            while position < stop:
+                offset = position % len(source)
+                count = min(WRITE_SIZE, stop - position, len(source) - offset)
+                self.wfile.write(source[offset:offset + count])
+                position += count
+                sent += count
+                if bandwidth:
+                    delay = sent / bandwidth - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        with self.server.lock:
+            self.server.bytes_sent += sent
+
+class MediaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, bandwidth=0, video_size=32 * 1024 * 1024,
+                 page_padding=150 * 1024, cover_size=40 * 1024, listing_pages=10, listing_size=32):
+        super().__init__(("127.0.0.1", port), MediaHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.video_size = video_size
+        self.page_padding = page_padding
+        self.cover_size = cover_size
+        self.listing_pages = listing_pages
+        self.listing_size = listing_size
+        self.pattern = make_pattern()
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.thread = None
+
+    def page_url(self, viewkey):
+        return f"{self.base_url}/view_video.php?viewkey={viewkey}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic watch pages and media for offline benchmarks.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added before every response")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Bytes per second per connection, 0 for unlimited")
+    parser.add_argument("--video-size", type=int, default=32 * 1024 * 1024)
+    args = parser.parse_args()
+
+    server = MediaServer(args.port, args.latency, args.bandwidth, args.video_size)
+    print(f"Serving on {server.base_url}, try {server.page_url('bench0')}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from core import (
+    DOWNLOAD_DIR,
+    CACHE_DIR,
+    DEFAULT_SEGMENTS,
+    DOWNLOAD_RETRIES,
+    DEFAULT_FSYNC,
+    FSYNC_POLICIES,
+    VERIFY_WORKERS,
+    verify_library,
+    DEFAULT_COOKIES,
+    DEFAULT_HEADERS,
+    POOL_MAX_PER_HOST,
+    REMUX_CONTAINERS,
+    METRICS_INTERVAL,
+    metrics,
+    format_metrics,
+    HttpClient,
+    MetadataCache,
+    DownloadIndex,
+    TransferFailed,
+    cache_key,
+    is_listing_url,
+    iter_listing,
+    create_downloader,
+    MediaExpired,
+    ResolveError,
+    resolve_page,
+    fetch_video_data,
+    quality_options,
+    pick_quality,
+    parse_quality_policy,
+    probe_sizes,
+    output_filename,
+    BandwidthLimiter,
+    format_size,
+    parse_rate,
+    parse_schedule,
+)
+
+def read_urls(source):
+    stream = sys.stdin if source == "-" else open(source, "r", encoding="utf-8")
+    try:
+        for line in stream:
+            # An optional number after the URL is its bandwidth weight
+            url, _, weight = line.strip().partition(" ")
+            if url and not url.startswith("#"):
+                try:
+                    yield url, float(weight) if weight.strip() else 1.0
+                except ValueError:
+                    yield url, 1.0
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+def expand_urls(entries, client, on_error):
+    # Listing pages turn into their videos while the crawl runs; repeats are dropped before any work
+    seen = set()
+    for url, weight in entries:
+        try:
+            video_urls = iter_listing(client, url) if is_listing_url(url) else [url]
+            for page_url in video_urls:
+                key = cache_key(page_url)
+                if key not in seen:
+                    seen.add(key)
+                    yield page_url, weight
+        except ResolveError as e:
+            on_error(url, str(e))
+        except requests.RequestException as e:
+            on_error(url, f"HTTP request error: {e}")
+        except ValueError as e:
+            on_error(url, f"Could not parse the listing page: {e}")
+
+def parse_quality(value):
+    try:
+        return parse_quality_policy(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"expected 'best', a height such as 720 or a size such as 500M, got {value!r}"
+        )
+
+def parse_rate_argument(value):
+    try:
+        return parse_rate(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def parse_schedule_argument(value):
+    try:
+        return parse_schedule(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def resolve_media(client, metadata_cache, page_url):
+    entry = metadata_cache.get(page_url) if metadata_cache else None
+    if entry:
+        return entry["title"], entry["last_media_url"], entry["media_definitions"], entry["video_data"]
+    media_definitions, video_title, last_media_url, cover_image_url = resolve_page(client, page_url)
+    if metadata_cache:
+        metadata_cache.store_page(page_url, video_title, cover_image_url, last_media_url, media_definitions)
+    return video_title, last_media_url, media_definitions, None
+
+def download_once(download_index, page_url, quality, start_download):
+    # Reuse a finished file or follow a transfer another worker already runs
+    if download_index is None:
+        return start_download(), None
+    key = cache_key(page_url)
+    entry = download_index.completed(key, quality)
+    if entry:
+        return entry["path"], "completed"
+    transfer, owner = download_index.begin(key, quality)
+    if not owner:
+        return transfer.wait(), "attached"
+    try:
+        filename = start_download()
+    except BaseException as e:
+        transfer.fail(str(e) or type(e).__name__)
+        raise
+    transfer.finish(filename)
+    return filename, None
+
+def process_url(page_url, client, metadata_cache, policy, output_dir, segments, remux=None,
+                download_index=None, weight=1.0, max_retries=DOWNLOAD_RETRIES, refresh_expired=True,
+                fsync=DEFAULT_FSYNC):
+    started = time.monotonic()
+    result = {"url": page_url}
+    try:
+        for attempt in range(2):
+            video_title, last_media_url, media_definitions, video_data = resolve_media(client, metadata_cache, page_url)
+            try:
+                if video_data is None:
+                    video_data = fetch_video_data(client, last_media_url)
+                    if metadata_cache:
+                        metadata_cache.store_video_data(page_url, video_data)
+
+                options = quality_options(video_data, media_definitions)
+                # Only a size cap needs the HEAD probes
+                sizes = probe_sizes(client, options) if policy["max_size"] else None
+                choice = pick_quality(options, policy["max_quality"], sizes, policy["max_size"])
+                if not choice:
+                    raise ResolveError("No quality options match the quality policy.")
+                quality, video_url = choice
+
+                filename = output_filename(video_title, quality, output_dir)
+                filename, duplicate = download_once(
+                    download_index, page_url, quality,
+                    lambda: create_downloader(
+                        video_url, client, filename, segments, remux=remux, weight=weight, max_retries=max_retries,
+                        fsync=fsync
+                    ).run()
+                )
+                break
+            except MediaExpired:
+                # Signed URLs went stale, resolve the page once more and continue from the journal
+                if attempt or not refresh_expired:
+                    raise
+                if metadata_cache:
+                    metadata_cache.invalidate(page_url)
+
+        result.update(
+            status="ok",
+            title=video_title,
+            quality=quality,
+            file=filename,
+            bytes=os.path.getsize(filename),
+        )
+        if duplicate:
+            result["duplicate"] = duplicate
+    except MediaExpired:
+        result.update(status="error", error="Media link expired.")
+    except ResolveError as e:
+        result.update(status="error", error=str(e))
+    except TransferFailed as e:
+        result.update(status="error", error=f"Duplicate download failed: {e}")
+    except requests.RequestException as e:
+        result.update(status="error", error=f"HTTP request error: {e}")
+    except ValueError as e:
+        result.update(status="error", error=f"JSON decoding error: {e}")
+    except OSError as e:
+        result.update(status="error", error=f"Error writing video: {e}")
+    result["seconds"] = round(time.monotonic() - started, 3)
+    return result
+
+def verify(root, workers, results):
+    # Re-hash every file listed in the manifests under root and report what no longer matches
+    counts = {}
+    started = time.monotonic()
+    for result in verify_library(root, workers):
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+        results.write(json.dumps(result) + "\n")
+        results.flush()
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "no files"
+    print(f"Verified: {summary} in {time.monotonic() - started:.1f}s", file=sys.stderr)
+    return 0 if set(counts) <= {"ok"} else 1
+
+def report_metrics(args, client, stop):
+    last_bytes = 0
+    last_time = time.monotonic()
+    while True:
+        stopped = stop.wait(METRICS_INTERVAL)
+        snapshot = metrics.snapshot()
+        now = time.monotonic()
+        throughput = (snapshot["transferred_bytes"] - last_bytes) / max(now - last_time, 1e-6)
+        last_bytes, last_time = snapshot["transferred_bytes"], now
+        if args.metrics:
+            metrics.write_prometheus(args.metrics)
+        if args.stats:
+            lines = format_metrics(snapshot, throughput)
+            for item in client.limiter.report()["items"]:
+                allotted = f"{format_size(item['allotted'])}/s" if item["allotted"] else "unlimited"
+                lines.append(f"{item['name']}: {format_size(item['actual'])}/s of {allotted}")
+            print("\n".join(lines), file=sys.stderr)
+        if stopped:
+            return
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download a batch of videos without the GUI.")
+    parser.add_argument("urls", nargs="?", default="-", help="File with one page URL per line, or - for stdin")
+    parser.add_argument("-q", "--quality", type=parse_quality, default=parse_quality_policy("best"),
+                        help="'best' (default), the highest height to accept, e.g. 720, or the largest file, e.g. 500M")
+    parser.add_argument("-o", "--output", default=DOWNLOAD_DIR, help="Directory for downloaded files")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="Items processed at the same time")
+    parser.add_argument("-s", "--segments", type=int, default=DEFAULT_SEGMENTS, help="Connections per download")
+    parser.add_argument("-r", "--results", default="-", help="JSON-lines results file, or - for stdout")
+    parser.add_argument("--remux", choices=sorted(REMUX_CONTAINERS),
+                        help="Stream downloads through ffmpeg into a faststart MP4 or an MKV")
+    parser.add_argument("--retries", type=int, default=DOWNLOAD_RETRIES,
+                        help="Attempts per connection after a network error or stall before giving up")
+    parser.add_argument("--no-refresh", action="store_true",
+                        help="Fail instead of re-resolving the page when a media link expires")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default=DEFAULT_FSYNC,
+                        help="none: leave flushing to the OS, end: sync before the final rename (default), "
+                             "journal: also sync before every resume checkpoint")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the metadata cache")
+    parser.add_argument("--no-index", action="store_true",
+                        help="Download even when the download index already has the file")
+    parser.add_argument("--limit", type=parse_rate_argument, default=0,
+                        help="Bandwidth cap shared by all downloads, e.g. 5M for 5 MB/s (default: unlimited)")
+    parser.add_argument("--limit-schedule", type=parse_schedule_argument, default=None,
+                        help="Caps by local time, e.g. 09:00-18:00=2M,18:00-09:00=0; outside them --limit applies")
+    parser.add_argument("--verify", metavar="DIR",
+                        help="Check every file in the manifests under DIR instead of downloading")
+    parser.add_argument("--verify-workers", type=int, default=VERIFY_WORKERS, help="Files hashed at the same time")
+    parser.add_argument("--events", help="Append per-stage timing events to this JSON-lines file")
+    parser.add_argument("--metrics", help="Keep a Prometheus textfile with counters and stage latencies here")
+    parser.add_argument("--stats", action="store_true", help="Print throughput and stage latencies to stderr")
+    args = parser.parse_args(argv)
+    if args.verify:
+        results = sys.stdout if args.results == "-" else open(args.results, "a", encoding="utf-8")
+        try:
+            return verify(args.verify, args.verify_workers, results)
+        finally:
+            if results is not sys.stdout:
+                results.close()
+    concurrency = max(1, args.concurrency)
+    if args.events:
+        metrics.open_events(args.events)
+
+    client = HttpClient(
+        DEFAULT_HEADERS,
+        DEFAULT_COOKIES,
+        max_per_host=max(POOL_MAX_PER_HOST, concurrency * (args.segments + 1)),
+        limiter=BandwidthLimiter(args.limit, args.limit_schedule),
+    )
+    metadata_cache = None if args.no_cache else MetadataCache(os.path.join(CACHE_DIR, "metadata.sqlite3"))
+    download_index = None if args.no_index else DownloadIndex(os.path.join(CACHE_DIR, "downloads.sqlite3"))
+    results = sys.stdout if args.results == "-" else open(args.results, "a", encoding="utf-8")
+    results_lock = threading.Lock()
+    counts = {"ok": 0, "error": 0}
+    started = time.monotonic()
+    stop_reporting = threading.Event()
+    reporter = None
+    if args.metrics or args.stats:
+        reporter = threading.Thread(target=report_metrics, args=(args, client, stop_reporting), daemon=True)
+        reporter.start()
+
+    def write_result(future):
+        record_result(future.result())
+
+    def record_result(result):
+        with results_lock:
+            counts[result["status"]] += 1
+            results.write(json.dumps(result) + "\n")
+            results.flush()
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Keep only a bounded number of URLs in flight so huge lists stream through
+            pending = set()
+            urls = expand_urls(
+                read_urls(args.urls), client,
+                lambda url, error: record_result({"url": url, "status": "error", "error": error})
+            )
+            for page_url, weight in urls:
+                if len(pending) >= concurrency * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                future = executor.submit(
+                    process_url, page_url, client, metadata_cache, args.quality, args.output, args.segments,
+                    args.remux, download_index, weight, max(0, args.retries), not args.no_refresh,
+                    args.fsync
+                )
+                future.add_done_callback(write_result)
+                pending.add(future)
+            wait(pending)
+    finally:
+        stop_reporting.set()
+        if reporter:
+            reporter.join()
+        client.close()
+        if metadata_cache:
+            metadata_cache.close()
+        if download_index:
+            download_index.close()
+        if results is not sys.stdout:
+            results.close()
+        metrics.close()
+
+    elapsed = time.monotonic() - started
+    print(f"Done: {counts['ok']} downloaded, {counts['error']} failed in {elapsed:.1f}s", file=sys.stderr)
+    return 0 if counts["error"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2441 @@
+import os
+import re
+import html
+import json
+import queue
+import random
+import hashlib
+import time
+import shutil
+import socket
+import sqlite3
+import threading
+import tempfile
+import subprocess
+import importlib.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse, parse_qs, urljoin, urlencode
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ProtocolError, ReadTimeoutError, DecodeError
+# BeautifulSoup is only the fallback parse, it loads on first use
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+DOWNLOAD_DIR = "download"
+CACHE_DIR = "cache"
+DEFAULT_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+CHUNK_TARGET_SECONDS = 0.1
+PROGRESS_INTERVAL = 0.25
+SPEED_SMOOTHING = 0.2
+JOURNAL_INTERVAL = 4 * 1024 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+WRITE_BUFFERS = 16
+FSYNC_POLICIES = ("none", "end", "journal")
+DEFAULT_FSYNC = "end"
+POOL_MAX_HOSTS = 10
+POOL_MAX_PER_HOST = 16
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+PAGE_CHUNK_SIZE = 16 * 1024
+SCAN_OVERLAP = 256
+METADATA_CACHE_TTL = 60 * 60
+METADATA_CACHE_MAX_ENTRIES = 5000
+METADATA_CACHE_MAX_BYTES = 64 * 1024 * 1024
+MEDIA_EXPIRY_MARGIN = 5 * 60
+EXPIRED_STATUS_CODES = (403, 410)
+DOWNLOAD_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRYABLE_STATUS_CODES = (408, 429)
+STALL_MIN_RATE = 8 * 1024
+STALL_WINDOW = 20.0
+REMUX_CONTAINERS = {"mp4": "mp4", "mkv": "matroska"}
+FFMPEG_MAX_PROCESSES = max(1, (os.cpu_count() or 2) // 2)
+SNIFF_SIZE = 64 * 1024
+SIZE_PROBE_WORKERS = 8
+LISTING_FANOUT = 4
+LISTING_MAX_PAGES = 200
+LISTING_PATH_PATTERN = re.compile(r"^/(playlist|model|pornstar|channels|users)/")
+WATCH_LINK_PATTERN = re.compile(r'href="([^"]*view_video\.php\?[^"]*viewkey=[^"]+)"')
+PAGE_LINK_PATTERN = re.compile(r'href="([^"]*[?&](?:amp;)?page=(\d+)[^"]*)"')
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+CHECKSUM_ALGORITHM = "sha256-4m"
+MANIFEST_NAME = ".pornland-manifest.json"
+VERIFY_WORKERS = os.cpu_count() or 4
+RATE_REBALANCE_INTERVAL = 1.0
+RATE_BURST_SECONDS = 0.25
+MIN_SHARE_RATE = 16 * 1024
+RATE_UNITS = {"": 1, "k": 1024, "m": 1024 * 1024, "g": 1024 * 1024 * 1024}
+METRICS_PREFIX = "pornland"
+METRICS_INTERVAL = 5.0
+SESSION_FIELDS = ("title", "cover_image_url", "quality", "state", "status", "filename", "downloaded", "total")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+DEFAULT_COOKIES = {
+    "__l": "65FC75EF-42FE722901BB121A2D-9ECE1D",
+    "__s": "6728CC3F-42FE722901BB876CE-1C075",
+    "_ga": "GA1.1.1777442377.1730726996",
+    "_ga_B39RFFWGYY": "GS1.1.1730726996.1.1.1730728319.59.0.0",
+    "accessAgeDisclaimerPH": "1",
+    "bs": "t6w44rd46bdjdh6nknndp2d0l8smghep",
+    "bsdd": "t6w44rd46bdjdh6nknndp2d0l8smghep",
+    "cookieConsent": "3",
+    "entryOrigin": "VidPg-premVid",
+    "etavt": "%7B%2266385e0dc12af%22%3A%221_24_2_NA%7C1%22%2C%22662c2f84c2f33%22%3A%225_2_2_pornhub.related_video.96%7C0%22%7D",
+    "fg_afaf12e314c5419a855ddc0bf120670f": "27930.100000",
+    "htjf-mobile": "1",
+    "lvv": "984390804839735301",
+    "platform": "pc",
+    "sessid": "101750858070270346",
+    "ss": "500721751518614168",
+    "ua": "c255ff0d5d20335c36999a538b820aaa",
+    "views": "6",
+    "vlc": "168270359546915842",
+}
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+                  "AppleWebKit/537.36 (KHTML, like Gecko) "
+                  "Chrome/92.0.4515.159 Safari/537.36",
+    'Accept': 'application/json, text/javascript, */*; q=0.01'
+}
+
+class ResolveError(Exception):
+    pass
+
+class MediaExpired(Exception):
+    pass
+
+class DownloadCancelled(Exception):
+    pass
+
+class TransferFailed(Exception):
+    pass
+
+class TransferStalled(requests.RequestException):
+    pass
+
+class Metrics:
+    # Stage timings, counters and a JSON-lines event log shared by every worker
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.events = None
+        self.started = time.monotonic()
+
+    def open_events(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            if self.events:
+                self.events.close()
+            self.events = open(path, "a", encoding="utf-8", buffering=1)
+
+    def close(self):
+        with self.lock:
+            if self.events:
+                self.events.close()
+                self.events = None
+
+    def stage(self, stage, **fields):
+        return StageTimer(self, stage, fields)
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, stage, seconds, outcome="ok", **fields):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            key = ("stage_total", (("outcome", outcome), ("stage", stage)))
+            self.counters[key] = self.counters.get(key, 0) + 1
+            if fields.get("bytes"):
+                key = ("bytes_total", (("stage", stage),))
+                self.counters[key] = self.counters.get(key, 0) + fields["bytes"]
+            if self.events:
+                event = {"time": round(time.time(), 3), "stage": stage, "seconds": round(seconds, 6), "outcome": outcome}
+                event.update(fields)
+                self.events.write(json.dumps(event, default=str) + "\n")
+
+    def counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def snapshot(self):
+        # Per stage count, errors, mean and bucket-estimated percentiles
+        with self.lock:
+            stages = {}
+            for stage, histogram in sorted(self.histograms.items()):
+                count = histogram["count"]
+                stages[stage] = {
+                    "count": count,
+                    "errors": sum(
+                        value for (name, labels), value in self.counters.items()
+                        if name == "stage_total" and ("stage", stage) in labels and ("outcome", "ok") not in labels
+                    ),
+                    "mean": histogram["sum"] / count if count else 0.0,
+                    "p50": self.percentile(histogram, 0.5),
+                    "p95": self.percentile(histogram, 0.95),
+                    "bytes": self.counters.get(("bytes_total", (("stage", stage),)), 0),
+                }
+            return {
+                "uptime": time.monotonic() - self.started,
+                "transferred_bytes": self.counters.get(("transferred_bytes", ()), 0),
+                "stages": stages,
+            }
+
+    def percentile(self, histogram, fraction):
+        # Upper bound of the bucket holding the percentile, good enough for a dashboard
+        target = histogram["count"] * fraction
+        for index, bound in enumerate(self.buckets):
+            if histogram["buckets"][index] >= target:
+                return bound
+        return float("inf")
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            name = f"{METRICS_PREFIX}_stage_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for stage, histogram in sorted(self.histograms.items()):
+                for bound, value in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {value}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram["sum"]:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram["count"]}')
+
+            typed = set()
+            for (counter_name, labels), value in sorted(self.counters.items()):
+                name = f"{METRICS_PREFIX}_{counter_name}"
+                if not name.endswith("_total"):
+                    name += "_total"
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # node_exporter's textfile collector must never see a half written file
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as prom_file:
+            prom_file.write(self.prometheus_text())
+        os.replace(temp_path, path)
+
+class StageTimer:
+    def __init__(self, metrics, stage, fields):
+        self.metrics = metrics
+        self.stage = stage
+        self.fields = fields
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self.fields
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            outcome = "ok"
+        elif issubclass(exc_type, DownloadCancelled):
+            outcome = "cancelled"
+        else:
+            outcome = "error"
+            self.fields["error"] = exc_type.__name__
+            response = getattr(exc, "response", None)
+            if response is not None and "status" not in self.fields:
+                self.fields["status"] = response.status_code
+        self.metrics.observe(self.stage, time.perf_counter() - self.started, outcome, **self.fields)
+        return False
+
+metrics = Metrics()
+
+def format_metrics(snapshot, throughput):
+    # One line for the aggregate rate, then one per stage
+    lines = [f"Throughput {format_size(throughput)}/s, {format_size(snapshot['transferred_bytes'])} transferred"]
+    for stage, stats in snapshot["stages"].items():
+        lines.append(
+            f"{stage:<10} n={stats['count']:<5} err={stats['errors']:<3} mean={stats['mean'] * 1000:8.1f}ms "
+            f"p50<={stats['p50'] * 1000:.0f}ms p95<={stats['p95'] * 1000:.0f}ms"
+        )
+    return lines
+
+class TimedConnectionMixin:
+    # Opening the socket covers DNS and TCP connect, the rest of connect() is TLS
+    socket_seconds = 0.0
+
+    def _new_conn(self):
+        started = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            self.socket_seconds = time.perf_counter() - started
+            metrics.observe("connect", self.socket_seconds, host=self.host)
+
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        if isinstance(self, HTTPSConnection):
+            metrics.observe("tls", time.perf_counter() - started - self.socket_seconds, host=self.host)
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+class HttpClient:
+    def __init__(self, headers, cookies, max_hosts=POOL_MAX_HOSTS, max_per_host=POOL_MAX_PER_HOST,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), limiter=None):
+        self.timeout = timeout
+        # Every transfer made through this client draws from the same bandwidth budget
+        self.limiter = limiter or BandwidthLimiter()
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.cookies.update(cookies)
+
+        # Block instead of opening throwaway connections once a host's pool is full
+        self.adapter = TimedHTTPAdapter(pool_connections=max_hosts, pool_maxsize=max_per_host, pool_block=True)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        # Returns once the headers are in, so this is time to first byte for streamed bodies
+        started = time.perf_counter()
+        response = self.session.request(method, url, **kwargs)
+        metrics.observe("ttfb", time.perf_counter() - started, method=method, status=response.status_code)
+        metrics.count("http_responses", status=response.status_code)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def pool_stats(self):
+        # A request that did not need a new connection reused a pooled one
+        pools = self.adapter.poolmanager.pools
+        stats = {"hosts": 0, "requests": 0, "hits": 0, "misses": 0}
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["hosts"] += 1
+            stats["requests"] += pool.num_requests
+            stats["misses"] += pool.num_connections
+        stats["hits"] = max(0, stats["requests"] - stats["misses"])
+        return stats
+
+    def close(self):
+        self.session.close()
+
+def resolve_page(client, page_url):
+    with metrics.stage("page", url=page_url) as event:
+        with client.get(page_url, stream=True) as response:
+            event["status"] = response.status_code
+            response.raise_for_status()
+            scanner, html_text = read_watch_page(response)
+        event["bytes"] = len(html_text)
+        event["fast_path"] = scanner.complete()
+
+    if scanner.complete():
+        flashvars_text = scanner.flashvars_text
+        cover_image_url = scanner.cover_image_url
+        video_title = scanner.video_title
+    else:
+        # Fast path missed something, parse the whole page
+        with metrics.stage("parse", url=page_url, bytes=len(html_text)):
+            flashvars_text, cover_image_url, video_title = parse_watch_page(html_text)
+
+    try:
+        flashvars_data = json.loads(flashvars_text)
+    except json.JSONDecodeError as e:
+        raise ResolveError(f"JSON parsing error: {e}")
+
+    media_definitions = flashvars_data.get('mediaDefinitions')
+    if not media_definitions:
+        raise ResolveError("No mediaDefinitions found in flashvars.")
+
+    last_media = media_definitions[-1]
+    if not last_media.get("remote", False):
+        raise ResolveError("Last media item does not have remote:true.")
+
+    last_media_url = last_media.get("videoUrl", "").replace("\\/", "/")
+    if not last_media_url:
+        raise ResolveError("Last media URL not found.")
+
+    return media_definitions, video_title, last_media_url, cover_image_url
+
+class WatchPageScanner:
+    player_pattern = re.compile(r'<[^>]+\bid=["\']player["\']')
+    flashvars_pattern = re.compile(r'flashvars_\d+\s*=\s*(\{.*?\});', re.DOTALL)
+    img_pattern = re.compile(r'<img\b[^>]*?\bsrc=["\']([^"\']+)["\']')
+    wrapper_pattern = re.compile(r'class=["\'][^"\']*\bvideo-wrapper\b')
+    title_pattern = re.compile(
+        r'class=["\'][^"\']*\btitle\b[^"\']*["\'][^>]*>\s*'
+        r'<[^>]+class=["\'][^"\']*\binlineFree\b[^"\']*["\'][^>]*>([^<]*)<'
+    )
+
+    def __init__(self):
+        self.buffer = ""
+        self.player_pos = -1
+        self.wrapper_pos = -1
+        self.flashvars_text = None
+        self.cover_image_url = ""
+        self.video_title = None
+
+    def feed(self, text):
+        # Rescan a little before the new text so matches can span chunk borders
+        rescan_from = max(0, len(self.buffer) - SCAN_OVERLAP)
+        self.buffer += text
+
+        if self.player_pos < 0:
+            match = self.player_pattern.search(self.buffer, rescan_from)
+            if match:
+                self.player_pos = match.start()
+        if self.player_pos >= 0:
+            if not self.cover_image_url:
+                match = self.img_pattern.search(self.buffer, self.player_pos)
+                if match:
+                    self.cover_image_url = html.unescape(match.group(1)).replace("\\/", "/")
+            if self.flashvars_text is None:
+                match = self.flashvars_pattern.search(self.buffer, self.player_pos)
+                if match:
+                    self.flashvars_text = match.group(1)
+
+        if self.wrapper_pos < 0:
+            match = self.wrapper_pattern.search(self.buffer, rescan_from)
+            if match:
+                self.wrapper_pos = match.start()
+        if self.wrapper_pos >= 0 and self.video_title is None:
+            match = self.title_pattern.search(self.buffer, self.wrapper_pos)
+            if match:
+                self.video_title = html.unescape(match.group(1)).strip() or "video"
+
+        return self.complete()
+
+    def complete(self):
+        return self.flashvars_text is not None and self.video_title is not None
+
+def read_watch_page(response):
+    # Stop pulling the page once the scanner has what it needs
+    if not response.encoding:
+        response.encoding = "utf-8"
+    scanner = WatchPageScanner()
+    for chunk in response.iter_content(chunk_size=PAGE_CHUNK_SIZE, decode_unicode=True):
+        if chunk and scanner.feed(chunk):
+            break
+    return scanner, scanner.buffer
+
+def parse_watch_page(html_text):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_text, HTML_PARSER)
+
+    player_div = soup.find(id="player")
+    if not player_div:
+        raise ResolveError("#player div not found.")
+
+    # Extract Cover Image URL
+    img_tag = player_div.find('img')
+    if img_tag and img_tag.get('src'):
+        cover_image_url = img_tag['src'].replace("\\/", "/")
+    else:
+        cover_image_url = ""
+
+    script_tag = None
+    for script in player_div.find_all('script'):
+        if re.search(r'flashvars_\d+', script.text):
+            script_tag = script
+            break
+
+    if not script_tag:
+        raise ResolveError("No matching script with flashvars found in #player.")
+
+    json_text = re.search(r'flashvars_\d+\s*=\s*(\{.*?\});', script_tag.string, re.DOTALL)
+    if not json_text:
+        raise ResolveError("flashvars JSON data not found.")
+
+    video_title_tag = soup.select_one(".video-wrapper .title .inlineFree")
+    video_title = video_title_tag.text.strip().replace(" ", " ") if video_title_tag else "video"
+
+    return json_text.group(1), cover_image_url, video_title
+
+def fetch_video_data(client, video_url):
+    with metrics.stage("video_data", url=video_url) as event:
+        try:
+            response = client.get(video_url)
+            event["status"] = response.status_code
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in EXPIRED_STATUS_CODES:
+                raise MediaExpired(video_url) from e
+            raise
+        event["bytes"] = len(response.content)
+        return response.json()
+
+def quality_options(video_data, media_definitions=()):
+    # Progressive MP4s from the get_media JSON, then HLS renditions from flashvars
+    options = []
+    for media in video_data:
+        quality = media.get("quality")
+        video_url = media.get("videoUrl", "").replace("\\/", "/")
+        if quality and video_url:
+            options.append((quality, video_url))
+    for media in media_definitions:
+        quality = media.get("quality")
+        video_url = media.get("videoUrl", "").replace("\\/", "/")
+        if media.get("format") == "hls" and isinstance(quality, str) and quality and video_url:
+            options.append((quality, video_url))
+    return options
+
+def is_hls_url(url):
+    return urlparse(url).path.endswith(".m3u8")
+
+def quality_label(quality, url, size=0):
+    label = f"{quality}p HLS" if is_hls_url(url) else f"{quality}p"
+    return f"{label} ({format_size(size)})" if size else label
+
+def quality_value(quality):
+    try:
+        return int(quality)
+    except (TypeError, ValueError):
+        return 0
+
+def pick_quality(options, max_quality=None, sizes=None, max_size=0):
+    # Highest quality, or the highest at or below max_quality and, given sizes, no bigger than max_size
+    allowed = [
+        option for index, option in enumerate(options)
+        if (max_quality is None or quality_value(option[0]) <= max_quality)
+        and (not max_size or 0 < (sizes[index] if sizes else 0) <= max_size)
+    ]
+    if not allowed:
+        return None
+    return max(allowed, key=lambda option: (quality_value(option[0]), not is_hls_url(option[1])))
+
+def parse_quality_policy(text):
+    # "best", a height such as 720 or 720p, or a size cap such as 500M
+    text = text.strip().lower()
+    if text == "best":
+        return {"max_quality": None, "max_size": 0}
+    if text.rstrip("p").isdigit():
+        return {"max_quality": int(text.rstrip("p")), "max_size": 0}
+    try:
+        max_size = parse_rate(text)
+    except ValueError:
+        raise ValueError(f"Invalid quality policy: {text!r}")
+    if not max_size:
+        raise ValueError(f"Invalid quality policy: {text!r}")
+    return {"max_quality": None, "max_size": max_size}
+
+def probe_size(client, url):
+    if is_hls_url(url):
+        return 0  # A playlist's length says nothing about the video
+    try:
+        response = client.head(url, allow_redirects=True)
+    except requests.RequestException:
+        return 0
+    if response.status_code >= 400:
+        return 0
+    try:
+        return int(response.headers.get('content-length', 0))
+    except ValueError:
+        return 0
+
+def probe_sizes(client, options, max_workers=SIZE_PROBE_WORKERS):
+    # HEAD every quality at once, 0 where the size is unknown
+    if not options:
+        return []
+    with metrics.stage("size_probe", count=len(options)):
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(options))) as executor:
+            return list(executor.map(lambda option: probe_size(client, option[1]), options))
+
+def is_listing_url(url):
+    # Playlists, models, pornstars, channels and users list videos instead of playing one
+    parsed = urlparse(url)
+    return "viewkey" not in parse_qs(parsed.query) and bool(LISTING_PATH_PATTERN.match(parsed.path))
+
+def listing_page_url(url, number):
+    parsed = urlparse(url)
+    query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+    query["page"] = str(number)
+    return parsed._replace(query=urlencode(query)).geturl()
+
+def listing_page_number(url):
+    page = parse_qs(urlparse(url).query).get("page")
+    return int(page[0]) if page and page[0].isdigit() else 1
+
+def parse_listing_page(html_text, page_url):
+    # Watch links in page order, and the numbers of the other pages of the same listing
+    videos = []
+    seen = set()
+    for href in WATCH_LINK_PATTERN.findall(html_text):
+        link = urlparse(urljoin(page_url, html.unescape(href)))
+        viewkey = parse_qs(link.query).get("viewkey")
+        if not viewkey:
+            continue
+        # Drop tracking parameters so the same video always has the same URL
+        video_url = f"{link.scheme}://{link.netloc}/view_video.php?viewkey={viewkey[0]}"
+        if video_url not in seen:
+            seen.add(video_url)
+            videos.append(video_url)
+    path = urlparse(page_url).path
+    pages = set()
+    for href, number in PAGE_LINK_PATTERN.findall(html_text):
+        if urlparse(urljoin(page_url, html.unescape(href))).path == path:
+            pages.add(int(number))
+    return videos, pages
+
+class ListingCrawler:
+    # Walks a paginated listing a few pages at a time and reports each page's videos as it arrives
+    def __init__(self, client, url, on_videos, fanout=LISTING_FANOUT, max_pages=LISTING_MAX_PAGES):
+        self.client = client
+        self.url = url
+        self.on_videos = on_videos
+        self.fanout = max(1, fanout)
+        self.max_pages = max_pages
+        self.cancel_event = threading.Event()
+        self.found = 0
+        self.failed_pages = 0
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        with metrics.stage("listing", url=self.url) as event:
+            first = listing_page_number(self.url)
+            seen = {first}
+            with ThreadPoolExecutor(max_workers=self.fanout) as executor:
+                pending = {executor.submit(self.fetch_page, first): first}
+                try:
+                    while pending and not self.cancel_event.is_set():
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            number = pending.pop(future)
+                            try:
+                                videos, pages = future.result()
+                            except (requests.RequestException, ValueError):
+                                if number == first:
+                                    raise
+                                # One missing page should not lose the rest of the listing
+                                self.failed_pages += 1
+                                metrics.count("listing_page_errors")
+                                continue
+                            if videos:
+                                self.found += len(videos)
+                                self.on_videos(videos)
+                            # Pagination shows a window of numbers, each page reveals the next ones
+                            for page in sorted(pages - seen):
+                                if len(seen) >= self.max_pages:
+                                    break
+                                seen.add(page)
+                                pending[executor.submit(self.fetch_page, page)] = page
+                finally:
+                    for future in pending:
+                        future.cancel()
+            event["pages"] = len(seen)
+            event["videos"] = self.found
+        if not self.found and not self.cancel_event.is_set():
+            raise ResolveError("No videos found on the listing page.")
+        return self.found
+
+    def fetch_page(self, number):
+        if self.cancel_event.is_set():
+            return [], set()
+        response = self.client.get(listing_page_url(self.url, number))
+        response.raise_for_status()
+        return parse_listing_page(response.text, response.url)
+
+def iter_listing(client, url, fanout=LISTING_FANOUT):
+    # Yields watch URLs while the crawl is still running
+    found = queue.Queue()
+    crawler = ListingCrawler(client, url, found.put, fanout)
+
+    def crawl():
+        try:
+            crawler.run()
+        except Exception as e:
+            found.put(e)
+        finally:
+            found.put(None)
+
+    threading.Thread(target=crawl, daemon=True).start()
+    try:
+        while True:
+            item = found.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+    finally:
+        crawler.cancel()
+
+def output_filename(video_title, quality, directory=DOWNLOAD_DIR):
+    safe_title = re.sub(r'[\\/*?:"<>|]', "", video_title)  # Remove illegal characters
+    return os.path.join(directory, f"{safe_title}_{quality}p.mp4")
+
+def create_downloader(download_url, client, filename, segments=DEFAULT_SEGMENTS, on_progress=None, remux=None,
+                      weight=1.0, max_retries=DOWNLOAD_RETRIES, fsync=DEFAULT_FSYNC):
+    if is_hls_url(download_url):
+        return HlsDownloader(download_url, client, filename, segments, on_progress, remux, weight, max_retries, fsync)
+    return Downloader(download_url, client, filename, segments, on_progress, remux, weight, max_retries, fsync)
+
+class Downloader:
+    def __init__(self, download_url, client, filename, segments=DEFAULT_SEGMENTS, on_progress=None, remux=None,
+                 weight=1.0, max_retries=DOWNLOAD_RETRIES, fsync=DEFAULT_FSYNC):
+        self.download_url = download_url
+        self.client = client
+        self.filename = filename
+        self.segments = max(1, int(segments))
+        self.on_progress = on_progress
+        self.remux = remux
+        self.weight = weight
+        self.share = None
+        self.max_retries = max_retries
+        self.fsync = fsync
+        self.retries = 0
+        self.checksum = None
+        self.stall_monitor = StallMonitor()
+        self.meter = TransferMeter()
+        self.journal = None
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        with metrics.stage("transfer", url=self.download_url, segments=self.segments) as event:
+            self.share = self.client.limiter.share(os.path.basename(self.filename), self.weight)
+            try:
+                return self.download()
+            finally:
+                self.stall_monitor.close()
+                self.client.limiter.release(self.share)
+                event["bytes"] = self.meter.downloaded - self.meter.skipped
+                event["retries"] = self.retries
+
+    def download(self):
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        part_filename = self.filename + ".part"
+
+        try:
+            if self.remux and ffmpeg_available():
+                return self.download_remuxed(remuxed_filename(self.filename, self.remux))
+            total_length, accepts_ranges, etag, last_modified = self.probe()
+            if accepts_ranges and total_length > 0:
+                self.download_resumable(part_filename, total_length, etag, last_modified)
+            else:
+                self.download_single(part_filename)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in EXPIRED_STATUS_CODES:
+                raise MediaExpired(self.download_url) from e
+            raise
+        commit_file(part_filename, self.filename, self.fsync)
+        if self.journal:
+            self.journal.delete()
+        record_manifest(self.filename, self.checksum)
+        return self.filename
+
+    def download_remuxed(self, filename):
+        response = self.client.get(self.download_url, stream=True)
+        try:
+            response.raise_for_status()
+            self.meter.total = int(response.headers.get('content-length', 0))
+            resumable = response.headers.get('accept-ranges', '').lower() == 'bytes'
+            chunks = self.iter_chunks(response)
+
+            head = b""
+            for chunk in chunks:
+                head += chunk
+                if len(head) >= SNIFF_SIZE:
+                    break
+            if mp4_layout(head) == "moov-last":
+                # ffmpeg cannot seek a pipe back to a trailing moov, let it read the URL itself
+                response.close()
+                return self.remux_from_url(filename)
+
+            remuxer = FfmpegRemuxer(filename, self.remux, self.cancel_event)
+            remuxer.open()
+            try:
+                remuxer.write(head)
+                self.add_progress(len(head))
+                written = len(head)
+                attempt = 0
+                while True:
+                    offset = written
+                    try:
+                        if chunks is None:
+                            # ffmpeg keeps its pipe open while we reconnect and continue from written
+                            response.close()
+                            response = self.client.get(
+                                self.download_url, headers={"Range": f"bytes={written}-"}, stream=True
+                            )
+                            response.raise_for_status()
+                            if response.status_code != 206:
+                                raise requests.RequestException(
+                                    f"Server ignored range request ({response.status_code})"
+                                )
+                            chunks = self.iter_chunks(response)
+                        for chunk in chunks:
+                            if self.cancel_event.is_set():
+                                raise DownloadCancelled()
+                            remuxer.write(chunk)
+                            written += len(chunk)
+                            self.add_progress(len(chunk))
+                        if self.meter.total and written < self.meter.total:
+                            # The server closed the body early, fetch the rest
+                            raise requests.RequestException(f"Received {written} of {self.meter.total} bytes")
+                        break
+                    except requests.RequestException as e:
+                        if not resumable:
+                            raise
+                        attempt = 0 if written > offset else attempt
+                        self.wait_before_retry(e, attempt, "remux")
+                        attempt += 1
+                        chunks = None
+            except BaseException:
+                remuxer.abort()
+                raise
+            remuxer.close()
+        finally:
+            response.close()
+        self.add_progress(0, force=True)
+        # ffmpeg wrote this file, so it is hashed from disk
+        record_manifest(filename, file_checksum(filename))
+        return filename
+
+    def remux_from_url(self, filename):
+        remuxer = FfmpegRemuxer(filename, self.remux, self.cancel_event)
+        remuxer.open(self.download_url, ffmpeg_headers(self.client))
+        try:
+            for output_size in remuxer.progress():
+                if self.cancel_event.is_set():
+                    raise DownloadCancelled()
+                # Output size is close enough to input size for a stream copy
+                self.add_progress(max(0, min(output_size, self.meter.total or output_size) - self.meter.downloaded))
+        except BaseException:
+            remuxer.abort()
+            raise
+        remuxer.close()
+        self.add_progress(0, force=True)
+        record_manifest(filename, file_checksum(filename))
+        return filename
+
+    def probe(self):
+        # Ask for the size, range support and validator without pulling the body
+        response = self.client.head(self.download_url, allow_redirects=True)
+        if response.status_code >= 400:
+            return 0, False, "", ""
+        total_length = int(response.headers.get('content-length', 0))
+        accepts_ranges = response.headers.get('accept-ranges', '').lower() == 'bytes'
+        etag = response.headers.get('etag', '')
+        last_modified = response.headers.get('last-modified', '')
+        return total_length, accepts_ranges, etag, last_modified
+
+    def download_single(self, filename):
+        attempt = 0
+        while True:
+            try:
+                self.fetch_single(filename)
+                return
+            except requests.RequestException as e:
+                # Without range support the only way back is from the first byte
+                self.wait_before_retry(e, attempt, "single")
+                attempt += 1
+                self.meter.restart()
+
+    def fetch_single(self, filename):
+        with self.client.get(self.download_url, stream=True) as video_response:
+            video_response.raise_for_status()
+            self.meter.total = int(video_response.headers.get('content-length', 0))
+            writer = FileWriter(filename, fsync=self.fsync).open(self.meter.total)
+            stream = WriteStream(writer, 0, self.cancel_event)
+            received = 0
+            try:
+                for chunk in self.iter_chunks(video_response):
+                    if self.cancel_event.is_set():
+                        raise DownloadCancelled()
+                    stream.write(chunk)
+                    received += len(chunk)
+                    self.add_progress(len(chunk))
+                # A body that ends early just stops, only the count tells
+                if self.meter.total and received != self.meter.total:
+                    raise requests.RequestException(f"Received {received} of {self.meter.total} bytes")
+                stream.close()
+                self.checksum = writer.close(received)
+            finally:
+                stream.close()
+                writer.close()
+            self.add_progress(0, force=True)
+
+    def download_resumable(self, filename, total_length, etag, last_modified):
+        self.meter.total = total_length
+        self.journal = DownloadJournal(filename + ".json")
+
+        resuming = (
+            self.journal.load()
+            and self.journal.matches(total_length, etag, last_modified)
+            and os.path.exists(filename)
+            and os.path.getsize(filename) == total_length
+        )
+        # A fresh start preallocates, so every range can write at its own offset
+        writer = FileWriter(filename, fsync=self.fsync).open(total_length, create=not resuming)
+        if not resuming:
+            self.journal.reset(total_length, etag, last_modified)
+
+        pending = self.journal.missing_ranges()
+        self.meter.skip(total_length - sum(end - start + 1 for start, end in pending))
+
+        work = queue.Queue()
+        for piece in plan_segments(pending, self.segments, MIN_SEGMENT_SIZE, HASH_BLOCK_SIZE):
+            work.put(piece)
+
+        errors = []
+        threads = []
+        try:
+            if not resuming:
+                self.journal.save()
+            for _ in range(min(self.segments, work.qsize())):
+                thread = threading.Thread(target=self.download_ranges, args=(writer, work, errors), daemon=True)
+                threads.append(thread)
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            complete = not errors and not self.cancel_event.is_set()
+            self.checksum = writer.close(total_length if complete else None)
+
+        if self.cancel_event.is_set():
+            raise DownloadCancelled()
+        if errors:
+            raise errors[0]
+        missing = self.journal.missing_ranges()
+        if missing:
+            raise requests.RequestException(f"Download incomplete, {len(missing)} ranges missing")
+        self.add_progress(0, force=True)
+
+    def download_ranges(self, writer, work, errors):
+        while not errors and not self.cancel_event.is_set():
+            try:
+                start, end = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.download_range(writer, start, end, errors)
+            except (requests.RequestException, OSError) as e:
+                errors.append(e)
+
+    def download_range(self, writer, start, end, errors):
+        # A failed or stalled range continues from its first missing byte on a fresh connection
+        cursor = [start]
+        attempt = 0
+        while True:
+            offset = cursor[0]
+            try:
+                self.fetch_range(writer, cursor, end, errors)
+                return
+            except requests.RequestException as e:
+                if errors or self.cancel_event.is_set():
+                    return
+                attempt = 0 if cursor[0] > offset else attempt
+                self.wait_before_retry(e, attempt, "range")
+                attempt += 1
+
+    def fetch_range(self, writer, cursor, end, errors):
+        start = cursor[0]
+        headers = {"Range": f"bytes={start}-{end}"}
+        with self.client.get(self.download_url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise requests.RequestException(f"Server ignored range request ({response.status_code})")
+            stream = WriteStream(writer, start, self.cancel_event)
+            position = start
+            recorded = start
+            try:
+                for chunk in self.iter_chunks(response):
+                    if errors or self.cancel_event.is_set():
+                        return
+                    chunk = chunk[:end - position + 1]
+                    stream.write(chunk)
+                    position += len(chunk)
+                    cursor[0] = position
+                    self.add_progress(len(chunk))
+                    if position - recorded >= JOURNAL_INTERVAL:
+                        self.record_range(stream, recorded, position)
+                        recorded = position
+                    if position > end:
+                        break
+            finally:
+                # Whatever was received is kept for the next attempt
+                stream.close()
+                if position > recorded:
+                    self.record_range(stream, recorded, position)
+            if position <= end:
+                raise requests.RequestException(f"Segment {start}-{end} ended early")
+
+    def iter_chunks(self, response):
+        watch = self.stall_monitor.watch(response, self.share)
+        try:
+            for chunk in iter_adaptive_chunks(response, share=self.share):
+                watch.count += len(chunk)
+                yield chunk
+        except Exception as e:
+            # Closing a stalled response surfaces as whatever the read happened to hit
+            if watch.stalled:
+                raise TransferStalled(f"Transfer stalled below {format_size(STALL_MIN_RATE)}/s") from e
+            raise
+        finally:
+            self.stall_monitor.unwatch(watch)
+        if watch.stalled:
+            raise TransferStalled(f"Transfer stalled below {format_size(STALL_MIN_RATE)}/s")
+
+    def wait_before_retry(self, error, attempt, stage):
+        # Re-raises errors that a retry will not fix, otherwise backs off
+        if not is_retryable(error) or attempt >= self.max_retries:
+            raise error
+        self.retries += 1
+        metrics.count("retries", stage=stage)
+        if self.cancel_event.wait(backoff_delay(attempt)):
+            raise DownloadCancelled()
+
+    def record_range(self, stream, start, end):
+        # The writer only updates the journal once the range is in the file
+        stream.flush()
+        stream.writer.then(lambda: self.save_range(start, end))
+
+    def save_range(self, start, end):
+        self.journal.add_range(start, end)
+        self.journal.save()
+
+    def add_progress(self, count, force=False):
+        metrics.count("transferred_bytes", count)
+        stats = self.meter.add(count, force)
+        if stats:
+            stats["allotted"] = self.share.allotted if self.share else 0
+            if self.on_progress:
+                self.on_progress(stats)
+
+class HlsDownloader:
+    def __init__(self, playlist_url, client, filename, window=DEFAULT_SEGMENTS, on_progress=None, remux=None,
+                 weight=1.0, max_retries=DOWNLOAD_RETRIES, fsync=DEFAULT_FSYNC):
+        self.playlist_url = playlist_url
+        self.client = client
+        self.filename = filename
+        self.window = max(1, int(window))
+        self.on_progress = on_progress
+        self.remux = remux or "mp4"  # Segments always need a container step
+        self.meter = TransferMeter()
+        self.weight = weight
+        self.share = None
+        self.max_retries = max_retries
+        self.fsync = fsync
+        self.retries = 0
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        with metrics.stage("transfer", url=self.playlist_url, hls=True) as event:
+            self.share = self.client.limiter.share(os.path.basename(self.filename), self.weight)
+            try:
+                return self.download()
+            finally:
+                self.client.limiter.release(self.share)
+                event["bytes"] = self.meter.downloaded
+                event["retries"] = self.retries
+
+    def download(self):
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        try:
+            segment_urls = self.load_segments()
+            if ffmpeg_available():
+                # Feed the ordered segments straight into ffmpeg, nothing is written twice
+                filename = remuxed_filename(self.filename, self.remux)
+                remuxer = FfmpegRemuxer(filename, self.remux, self.cancel_event)
+                remuxer.open()
+                try:
+                    self.download_segments(segment_urls, remuxer)
+                except BaseException:
+                    remuxer.abort()
+                    raise
+                remuxer.close()
+                record_manifest(filename, file_checksum(filename))
+                return filename
+
+            # Without ffmpeg the joined transport stream is the result, hashed on its way to the writer
+            filename = os.path.splitext(self.filename)[0] + ".ts"
+            writer = FileWriter(filename + ".part", fsync=self.fsync).open()
+            stream = WriteStream(writer, 0, self.cancel_event)
+            try:
+                self.download_segments(segment_urls, stream)
+                stream.close()
+                checksum = writer.close(stream.offset)
+            finally:
+                stream.close()
+                writer.close()
+            commit_file(filename + ".part", filename, self.fsync)
+            record_manifest(filename, checksum)
+            return filename
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in EXPIRED_STATUS_CODES:
+                raise MediaExpired(self.playlist_url) from e
+            raise
+
+    def load_segments(self):
+        playlist_url = self.playlist_url
+        text = self.fetch_text(playlist_url)
+        variants = parse_master_playlist(text, playlist_url)
+        if variants:
+            # A master playlist, follow the highest bandwidth variant
+            playlist_url = max(variants)[1]
+            text = self.fetch_text(playlist_url)
+        return parse_media_playlist(text, playlist_url)
+
+    def fetch_text(self, url):
+        response = self.client.get(url)
+        response.raise_for_status()
+        return response.text
+
+    def download_segments(self, segment_urls, stream_file):
+        # Fetch up to window segments ahead and write them strictly in order
+        pending = deque()
+        next_index = 0
+        written = 0
+        with ThreadPoolExecutor(max_workers=self.window) as executor:
+            try:
+                while written < len(segment_urls):
+                    if self.cancel_event.is_set():
+                        raise DownloadCancelled()
+                    while next_index < len(segment_urls) and len(pending) < self.window:
+                        pending.append(executor.submit(self.fetch_segment, segment_urls[next_index]))
+                        next_index += 1
+                    data = pending.popleft().result()
+                    stream_file.write(data)
+                    written += 1
+                    # The byte total is only known at the end, extrapolate from what we have
+                    self.meter.total = int(self.meter.downloaded + len(data)) * len(segment_urls) // written
+                    self.add_progress(len(data), force=written == len(segment_urls))
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def fetch_segment(self, url):
+        # A failed segment is retried on its own, the rest of the stream is kept
+        for attempt in range(self.max_retries + 1):
+            if self.cancel_event.is_set():
+                raise DownloadCancelled()
+            try:
+                response = self.client.get(url)
+                response.raise_for_status()
+                # Segments are small, pay for them after the fact
+                self.share.consume(len(response.content))
+                return response.content
+            except requests.RequestException as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+            self.retries += 1
+            metrics.count("retries", stage="hls_segment")
+            if self.cancel_event.wait(backoff_delay(attempt)):
+                raise DownloadCancelled()
+
+    def add_progress(self, count, force=False):
+        metrics.count("transferred_bytes", count)
+        stats = self.meter.add(count, force)
+        if stats:
+            stats["allotted"] = self.share.allotted if self.share else 0
+        if stats and self.on_progress:
+            self.on_progress(stats)
+
+def parse_master_playlist(text, base_url):
+    # (bandwidth, url) for every variant stream in a master playlist
+    variants = []
+    bandwidth = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            match = re.search(r'(?:^|,)BANDWIDTH=(\d+)', line[len("#EXT-X-STREAM-INF:"):])
+            bandwidth = int(match.group(1)) if match else 0
+        elif line and not line.startswith("#") and bandwidth is not None:
+            variants.append((bandwidth, urljoin(base_url, line)))
+            bandwidth = None
+    return variants
+
+def parse_media_playlist(text, base_url):
+    segment_urls = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-KEY:") and "METHOD=NONE" not in line:
+            raise ResolveError("Encrypted HLS streams are not supported.")
+        if line.startswith("#EXT-X-BYTERANGE"):
+            raise ResolveError("HLS byte range segments are not supported.")
+        if line.startswith("#EXT-X-MAP:"):
+            match = re.search(r'URI="([^"]+)"', line)
+            if match:
+                segment_urls.append(urljoin(base_url, match.group(1)))
+        elif line and not line.startswith("#"):
+            segment_urls.append(urljoin(base_url, line))
+    if not segment_urls:
+        raise ResolveError("HLS playlist has no segments.")
+    return segment_urls
+
+ffmpeg_slots = threading.BoundedSemaphore(FFMPEG_MAX_PROCESSES)
+
+def ffmpeg_available():
+    return shutil.which("ffmpeg") is not None
+
+def remuxed_filename(filename, container):
+    return os.path.splitext(filename)[0] + "." + container
+
+def ffmpeg_headers(client):
+    # ffmpeg manages its own connection and encoding headers
+    lines = [
+        f"{name}: {value}" for name, value in client.session.headers.items()
+        if name.lower() not in ("accept-encoding", "connection")
+    ]
+    cookies = "; ".join(f"{cookie.name}={cookie.value}" for cookie in client.session.cookies)
+    if cookies:
+        lines.append(f"Cookie: {cookies}")
+    return "".join(line + "\r\n" for line in lines)
+
+def mp4_layout(head):
+    # Walk the top level boxes to see whether moov comes before mdat
+    position = 0
+    while position + 8 <= len(head):
+        size = int.from_bytes(head[position:position + 4], "big")
+        box_type = head[position + 4:position + 8]
+        if position == 0 and box_type != b"ftyp":
+            return "other"
+        if box_type == b"moov":
+            return "moov-first"
+        if box_type == b"mdat":
+            return "moov-last"
+        if size == 1:
+            if position + 16 > len(head):
+                break
+            size = int.from_bytes(head[position + 8:position + 16], "big")
+        if size < 8:
+            break
+        position += size
+    return "unknown"
+
+class FfmpegRemuxer:
+    def __init__(self, filename, container, cancel_event=None):
+        self.filename = filename
+        self.part_filename = filename + ".part"
+        self.container = container
+        self.cancel_event = cancel_event or threading.Event()
+        self.process = None
+        self.stderr = None
+
+    def open(self, url=None, headers=None):
+        # Wait for a free slot, checking for cancel so a paused item does not hang here
+        while not ffmpeg_slots.acquire(timeout=0.5):
+            if self.cancel_event.is_set():
+                raise DownloadCancelled()
+
+        command = [shutil.which("ffmpeg"), "-y", "-loglevel", "error", "-nostats"]
+        if url:
+            command += ["-progress", "pipe:1", "-headers", headers, "-i", url]
+        else:
+            command += ["-i", "pipe:0"]
+        command += ["-c", "copy"]
+        if self.container == "mp4":
+            command += ["-bsf:a", "aac_adtstoasc", "-movflags", "+faststart"]
+        command += ["-f", REMUX_CONTAINERS[self.container], self.part_filename]
+
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.process = subprocess.Popen(
+                command,
+                stdin=subprocess.DEVNULL if url else subprocess.PIPE,
+                stdout=subprocess.PIPE if url else subprocess.DEVNULL,
+                stderr=self.stderr,
+            )
+        except OSError:
+            ffmpeg_slots.release()
+            raise
+
+    def write(self, data):
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            raise OSError(f"ffmpeg stopped reading: {self.error_output()}")
+
+    def progress(self):
+        for line in self.process.stdout:
+            key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+            if key == "total_size" and value.isdigit():
+                yield int(value)
+
+    def close(self):
+        try:
+            if self.process.stdin:
+                self.process.stdin.close()
+            return_code = self.process.wait()
+        finally:
+            ffmpeg_slots.release()
+        if return_code != 0:
+            message = self.error_output()
+            self.remove_part()
+            raise OSError(f"ffmpeg exited with {return_code}: {message}")
+        os.replace(self.part_filename, self.filename)
+
+    def abort(self):
+        if self.process is None:
+            return
+        self.process.kill()
+        self.process.wait()
+        ffmpeg_slots.release()
+        self.process = None
+        self.remove_part()
+
+    def remove_part(self):
+        try:
+            os.remove(self.part_filename)
+        except FileNotFoundError:
+            pass
+
+    def error_output(self):
+        self.stderr.seek(0)
+        return self.stderr.read().decode("utf-8", "replace").strip()[-500:]
+
+class TransferMeter:
+    def __init__(self, interval=PROGRESS_INTERVAL, smoothing=SPEED_SMOOTHING):
+        self.interval = interval
+        self.smoothing = smoothing
+        self.total = 0
+        self.downloaded = 0
+        self.skipped = 0
+        self.speed = 0.0
+        self.smoothed_speed = None
+        self.last_time = time.monotonic()
+        self.last_downloaded = 0
+        self.lock = threading.Lock()
+
+    def skip(self, count):
+        # Bytes already on disk count as done but not towards the speed
+        with self.lock:
+            self.downloaded += count
+            self.skipped += count
+            self.last_downloaded += count
+
+    def restart(self):
+        # The transfer starts over from its first byte
+        with self.lock:
+            self.downloaded = self.skipped
+            self.last_downloaded = self.downloaded
+
+    def add(self, count, force=False):
+        # Coalesce reports so the GUI sees at most one per interval
+        with self.lock:
+            self.downloaded += count
+            now = time.monotonic()
+            elapsed = now - self.last_time
+            if elapsed < self.interval and not force:
+                return None
+            if elapsed > 0:
+                self.speed = (self.downloaded - self.last_downloaded) / elapsed
+                if self.smoothed_speed is None:
+                    self.smoothed_speed = self.speed
+                else:
+                    self.smoothed_speed += self.smoothing * (self.speed - self.smoothed_speed)
+            self.last_time = now
+            self.last_downloaded = self.downloaded
+
+            smoothed_speed = self.smoothed_speed or 0.0
+            if self.total > 0:
+                percent = min(100, int(self.downloaded * 100 / self.total))
+                eta = (self.total - self.downloaded) / smoothed_speed if smoothed_speed > 0 else -1
+            else:
+                percent = 0
+                eta = -1
+            return {
+                "percent": percent,
+                "downloaded": self.downloaded,
+                "total": self.total,
+                "speed": self.speed,
+                "smoothed_speed": smoothed_speed,
+                "eta": eta,
+            }
+
+def is_retryable(error):
+    # Expired signatures and client errors need a new URL, not another attempt
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else 0
+        return status >= 500 or status in RETRYABLE_STATUS_CODES
+    return isinstance(error, requests.RequestException)
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, maximum=RETRY_MAX_DELAY):
+    # Full jitter so segments that failed together do not retry together
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+class StallMonitor:
+    # Closes streams that move less than min_rate bytes/s over a whole window
+    def __init__(self, min_rate=STALL_MIN_RATE, window=STALL_WINDOW):
+        self.min_rate = min_rate
+        self.window = window
+        self.lock = threading.Lock()
+        self.watches = set()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def watch(self, response, share=None):
+        watch = StreamWatch(response, share)
+        with self.lock:
+            self.watches.add(watch)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return watch
+
+    def unwatch(self, watch):
+        with self.lock:
+            self.watches.discard(watch)
+
+    def run(self):
+        while not self.stop_event.wait(1.0):
+            now = time.monotonic()
+            with self.lock:
+                watches = list(self.watches)
+            for watch in watches:
+                elapsed = now - watch.window_start
+                if elapsed < self.window:
+                    continue
+                # A bandwidth cap below the stall floor is not a stall
+                throttled = watch.share and 0 < watch.share.allotted < self.min_rate * 2
+                if watch.count < self.min_rate * elapsed and not throttled:
+                    watch.stalled = True
+                    metrics.count("stalls")
+                    self.unwatch(watch)
+                    abort_response(watch.response)
+                else:
+                    watch.window_start = now
+                    watch.count = 0
+
+    def close(self):
+        self.stop_event.set()
+
+def abort_response(response):
+    # close() alone does not wake a thread blocked in recv, shutting the socket down does
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+class StreamWatch:
+    def __init__(self, response, share=None):
+        self.response = response
+        self.share = share
+        self.count = 0
+        self.window_start = time.monotonic()
+        self.stalled = False
+
+class ChunkSizer:
+    def __init__(self, minimum=MIN_CHUNK_SIZE, maximum=MAX_CHUNK_SIZE, target_seconds=CHUNK_TARGET_SECONDS):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.size = minimum
+
+    def update(self, count, elapsed):
+        # Aim for reads that take about target_seconds at the measured rate
+        if count < self.size:
+            return
+        wanted = count / elapsed * self.target_seconds if elapsed > 0 else self.maximum
+        if wanted >= self.size * 2:
+            self.size = min(self.maximum, self.size * 2)
+        elif wanted < self.size / 2:
+            self.size = max(self.minimum, self.size // 2)
+
+def iter_adaptive_chunks(response, sizer=None, share=None):
+    sizer = sizer or ChunkSizer()
+    while True:
+        size = share.acquire(sizer.size) if share else sizer.size
+        started = time.monotonic()
+        try:
+            chunk = response.raw.read(size, decode_content=True)
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        if share and len(chunk) < size:
+            share.refund(size - len(chunk))
+        if not chunk:
+            return
+        sizer.update(len(chunk), time.monotonic() - started)
+        yield chunk
+
+class BandwidthLimiter:
+    # Token buckets per transfer, refilled from one aggregate cap split by weight
+    def __init__(self, rate=0, schedule=None):
+        self.base_rate = rate
+        self.schedule = schedule or []
+        self.lock = threading.Lock()
+        self.shares = []
+        self.rate = self.current_rate()
+        self.last_rebalance = time.monotonic()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.base_rate = rate
+            self.rebalance(time.monotonic())
+
+    def set_schedule(self, schedule):
+        with self.lock:
+            self.schedule = schedule
+            self.rebalance(time.monotonic())
+
+    def current_rate(self):
+        # The first schedule window containing the local time wins, else the base rate
+        if self.schedule:
+            now = time.localtime()
+            minute = now.tm_hour * 60 + now.tm_min
+            for start, end, rate in self.schedule:
+                if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                    return rate
+        return self.base_rate
+
+    def share(self, name, weight=1.0):
+        share = BandwidthShare(self, name, weight)
+        with self.lock:
+            self.shares.append(share)
+            self.rebalance(time.monotonic())
+        return share
+
+    def release(self, share):
+        with self.lock:
+            if share in self.shares:
+                self.shares.remove(share)
+                self.rebalance(time.monotonic())
+
+    def rebalance(self, now):
+        # Caller holds the lock; shares that cannot use their part give it to the others
+        for share in self.shares:
+            share.measure(now)
+        self.last_rebalance = now
+        self.rate = self.current_rate()
+        if not self.rate:
+            for share in self.shares:
+                share.allot(0)
+            return
+
+        remaining = self.rate
+        pending = list(self.shares)
+        while pending:
+            total_weight = sum(share.weight for share in pending)
+            # Only a share that used less than it was allowed for a whole window is trimmed;
+            # the smoothed speed lags behind a raised allotment and would pull it straight back
+            limited = [
+                share for share in pending
+                if share.steady_allotted and share.rate < share.steady_allotted * 0.9
+                and share.rate * 1.25 < remaining * share.weight / total_weight
+            ]
+            if not limited:
+                break
+            for share in limited:
+                share.allot(max(MIN_SHARE_RATE, share.rate * 1.25))
+                remaining -= share.allotted
+                pending.remove(share)
+        total_weight = sum(share.weight for share in pending)
+        for share in pending:
+            share.allot(max(MIN_SHARE_RATE, remaining * share.weight / total_weight))
+
+    def report(self):
+        with self.lock:
+            return {
+                "rate": self.rate,
+                "items": [
+                    {"name": share.name, "weight": share.weight, "allotted": share.allotted, "actual": share.actual}
+                    for share in self.shares
+                ],
+            }
+
+class BandwidthShare:
+    def __init__(self, limiter, name, weight=1.0):
+        self.limiter = limiter
+        self.name = name
+        self.weight = max(0.01, weight)
+        self.allotted = 0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.window_start = self.updated
+        self.transferred = 0
+        self.last_transferred = 0
+        self.actual = 0.0
+        self.rate = 0.0
+        self.measured = False
+        # Lowest allotment held during the current window, and during the last full one (0 while unknown)
+        self.window_allotted = float("inf")
+        self.steady_allotted = 0
+
+    def allot(self, rate):
+        # Caller holds the limiter lock; 0 is unlimited
+        self.allotted = rate
+        self.window_allotted = min(self.window_allotted, rate or float("inf"))
+
+    def measure(self, now):
+        elapsed = now - self.window_start
+        if elapsed < RATE_REBALANCE_INTERVAL:
+            return
+        rate = (self.transferred - self.last_transferred) / elapsed
+        self.actual = rate if not self.measured else self.actual + SPEED_SMOOTHING * (rate - self.actual)
+        # The first window includes connecting, so it never counts as steady
+        if self.measured and self.window_allotted != float("inf"):
+            self.steady_allotted = self.window_allotted
+        else:
+            self.steady_allotted = 0
+        self.rate = rate
+        self.window_allotted = self.allotted or float("inf")
+        self.last_transferred = self.transferred
+        self.window_start = now
+        self.measured = True
+
+    def acquire(self, count):
+        # Small reads at low rates keep the flow smooth instead of bursty
+        if self.allotted:
+            count = min(count, max(MIN_CHUNK_SIZE, int(self.allotted * CHUNK_TARGET_SECONDS)))
+        self.consume(count)
+        return count
+
+    def consume(self, count):
+        # Take count bytes of budget and wait off any debt
+        limiter = self.limiter
+        now = time.monotonic()
+        if not limiter.rate and now - limiter.last_rebalance < RATE_REBALANCE_INTERVAL:
+            # Segment threads share this share, the count is only safe under the lock
+            with limiter.lock:
+                self.transferred += count
+            return
+        with limiter.lock:
+            if now - limiter.last_rebalance >= RATE_REBALANCE_INTERVAL:
+                limiter.rebalance(now)
+            if not self.allotted:
+                self.transferred += count
+                return
+            self.refill(time.monotonic())
+            self.tokens -= count
+            self.transferred += count
+        while True:
+            with limiter.lock:
+                self.refill(time.monotonic())
+                if self.tokens >= 0 or not self.allotted:
+                    return
+                wait = -self.tokens / self.allotted
+            # Wake up at least once per interval so a changed cap takes effect
+            time.sleep(min(wait, RATE_REBALANCE_INTERVAL))
+
+    def refund(self, count):
+        with self.limiter.lock:
+            self.tokens += count
+            self.transferred -= count
+
+    def refill(self, now):
+        burst = self.allotted * RATE_BURST_SECONDS
+        if now > self.updated:
+            self.tokens = min(burst, self.tokens + (now - self.updated) * self.allotted)
+            self.updated = now
+
+def parse_rate(text):
+    # "0" or "" for unlimited, otherwise bytes per second with an optional K, M or G suffix
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?(?:/s)?\s*", text.lower())
+    if not match:
+        raise ValueError(f"Invalid rate: {text!r}")
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2)])
+
+def parse_schedule(text):
+    # "09:00-18:00=2M,18:00-09:00=0" into (start minute, end minute, rate) windows
+    schedule = []
+    for window in filter(None, (part.strip() for part in text.split(","))):
+        match = re.fullmatch(r"(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)", window)
+        if not match:
+            raise ValueError(f"Invalid schedule window: {window!r}")
+        start = int(match.group(1)) * 60 + int(match.group(2))
+        end = int(match.group(3)) * 60 + int(match.group(4))
+        schedule.append((start, end, parse_rate(match.group(5))))
+    return schedule
+
+def format_size(count):
+    for unit in ("B", "KB", "MB", "GB"):
+        if count < 1024 or unit == "GB":
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024
+
+def format_eta(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def commit_file(part_filename, filename, fsync=DEFAULT_FSYNC):
+    # The data reaches the disk before the new name does
+    if fsync != "none":
+        sync_file(part_filename)
+    os.replace(part_filename, filename)
+    if fsync != "none":
+        sync_directory(os.path.dirname(filename))
+
+def preallocate(fd, size):
+    # Reserve the blocks up front so ranges landing out of order do not fragment the file
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # Filesystem without fallocate support
+    os.ftruncate(fd, size)
+
+def sync_file(path):
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_directory(path):
+    # Makes a rename durable; not every platform can open a directory
+    try:
+        fd = os.open(path or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_at(fd, views, offset):
+    if hasattr(os, "pwritev"):
+        written = os.pwritev(fd, views, offset)
+        if written == sum(len(view) for view in views):
+            return
+        data = memoryview(b"".join(views))[written:]
+        offset += written
+    else:
+        data = memoryview(b"".join(views)) if len(views) > 1 else views[0]
+    os.lseek(fd, offset, os.SEEK_SET)
+    while data:
+        data = data[os.write(fd, data):]
+
+class BufferPool:
+    # A fixed set of reusable buffers; take() blocks while all of them wait for the disk
+    def __init__(self, count=WRITE_BUFFERS, size=WRITE_BUFFER_SIZE):
+        self.size = size
+        self.free = queue.Queue()
+        for _ in range(count):
+            self.free.put(bytearray(size))
+
+    def take(self, cancel_event=None):
+        while True:
+            try:
+                return self.free.get(timeout=0.1)
+            except queue.Empty:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise DownloadCancelled()
+
+    def give(self, buffer):
+        self.free.put(buffer)
+
+class FileWriter:
+    # One thread owns the output file; readers hand it filled buffers and go back to the socket
+    def __init__(self, filename, pool=None, fsync=DEFAULT_FSYNC):
+        self.filename = filename
+        self.pool = pool or BufferPool()
+        self.fsync = fsync
+        self.queue = queue.Queue()
+        self.hasher = BlockHasher()
+        self.error = None
+        self.fd = None
+        self.thread = None
+
+    def open(self, size=0, create=True):
+        # Readable too, blocks the hasher could not follow are read back at the end
+        flags = os.O_RDWR | getattr(os, "O_BINARY", 0)
+        if create:
+            flags |= os.O_CREAT | os.O_TRUNC
+        self.fd = os.open(self.filename, flags, 0o666)
+        try:
+            if create and size:
+                preallocate(self.fd, size)
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def write(self, offset, buffer, length):
+        if self.error:
+            self.pool.give(buffer)
+            raise self.error
+        self.queue.put((offset, buffer, length))
+
+    def then(self, callback):
+        # Runs on the writer thread once everything queued before it is in the file
+        self.queue.put((None, callback, 0))
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            # Take what else is waiting so neighbouring buffers go out in one call
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            run_offset, run_items = 0, []
+            for item in batch + [None]:
+                if item is not None and item[0] is not None and run_items and item[0] == run_offset:
+                    run_items.append(item)
+                    run_offset += item[2]
+                    continue
+                if run_items:
+                    self.flush(run_items)
+                    run_items = []
+                if item is None:
+                    continue
+                if item[0] is not None:
+                    run_items = [item]
+                    run_offset = item[0] + item[2]
+                elif self.error is None:
+                    self.call(item[1])
+            running = None not in batch
+
+    def flush(self, items):
+        try:
+            if self.error is None:
+                write_at(self.fd, [memoryview(buffer)[:length] for _, buffer, length in items], items[0][0])
+        except OSError as e:
+            self.error = e
+        finally:
+            for _, buffer, _ in items:
+                self.pool.give(buffer)
+
+    def call(self, callback):
+        try:
+            if self.fsync == "journal":
+                os.fsync(self.fd)
+            callback()
+        except OSError as e:
+            self.error = e
+
+    def close(self, size=None):
+        # Waits until every queued buffer is written; given the final size it returns the file's checksum
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.fd is None:
+            return None
+        try:
+            if self.error:
+                raise self.error
+            return self.hasher.hexdigest(self.fd, size) if size is not None else None
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+class WriteStream:
+    # Packs one reader's chunks into pool buffers and hands each full one to the writer
+    def __init__(self, writer, offset, cancel_event=None):
+        self.writer = writer
+        self.offset = offset
+        self.cancel_event = cancel_event
+        self.buffer = None
+        self.filled = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        # Each range hashes its own blocks on its reader thread, so the hashing runs in parallel
+        self.writer.hasher.update(self.offset + self.filled, view)
+        while view:
+            if self.buffer is None:
+                self.buffer = self.writer.pool.take(self.cancel_event)
+            count = min(len(view), len(self.buffer) - self.filled)
+            self.buffer[self.filled:self.filled + count] = view[:count]
+            self.filled += count
+            view = view[count:]
+            if self.filled == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        if self.filled:
+            buffer, length = self.buffer, self.filled
+            self.buffer, self.filled = None, 0
+            self.offset += length
+            self.writer.write(self.offset - length, buffer, length)
+
+    def close(self):
+        self.flush()
+        if self.buffer is not None:
+            self.writer.pool.give(self.buffer)
+            self.buffer = None
+
+class DownloadJournal:
+    def __init__(self, path):
+        self.path = path
+        self.total_length = 0
+        self.etag = ""
+        self.last_modified = ""
+        self.ranges = []  # Sorted, merged half-open [start, end) byte ranges
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as journal_file:
+                data = json.load(journal_file)
+            self.total_length = int(data["total_length"])
+            self.etag = data.get("etag", "")
+            self.last_modified = data.get("last_modified", "")
+            self.ranges = [tuple(r) for r in data.get("ranges", [])]
+            return True
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def matches(self, total_length, etag, last_modified):
+        if self.total_length != total_length:
+            return False
+        if etag and self.etag:
+            return etag == self.etag
+        if last_modified and self.last_modified:
+            return last_modified == self.last_modified
+        return True
+
+    def reset(self, total_length, etag, last_modified):
+        with self.lock:
+            self.total_length = total_length
+            self.etag = etag
+            self.last_modified = last_modified
+            self.ranges = []
+
+    def add_range(self, start, end):
+        with self.lock:
+            merged = []
+            for range_start, range_end in sorted(self.ranges + [(start, end)]):
+                if merged and range_start <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+                else:
+                    merged.append((range_start, range_end))
+            self.ranges = merged
+
+    def missing_ranges(self):
+        # Inclusive byte ranges still to fetch
+        with self.lock:
+            missing = []
+            position = 0
+            for start, end in self.ranges:
+                if start > position:
+                    missing.append((position, start - 1))
+                position = max(position, end)
+            if position < self.total_length:
+                missing.append((position, self.total_length - 1))
+            return missing
+
+    def save(self):
+        with self.lock:
+            data = {
+                "total_length": self.total_length,
+                "etag": self.etag,
+                "last_modified": self.last_modified,
+                "ranges": self.ranges,
+            }
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as journal_file:
+                json.dump(data, journal_file)
+            os.replace(temp_path, self.path)
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+def plan_segments(pending, segments, min_size, align=1):
+    # Cut the pending inclusive ranges into pieces of roughly equal size, ending on align boundaries
+    remaining = sum(end - start + 1 for start, end in pending)
+    piece_size = max(min_size, -(-remaining // segments))
+    # Whole align blocks per piece, so each block is written front to back by a single range
+    piece_size = -(-piece_size // align) * align
+    pieces = []
+    for start, end in pending:
+        while start <= end:
+            aligned_end = (start + piece_size) // align * align - 1
+            piece_end = min(end, aligned_end if aligned_end >= start else start + piece_size - 1)
+            if end - piece_end < min_size:
+                piece_end = end
+            pieces.append((start, piece_end))
+            start = piece_end + 1
+    return pieces
+
+class MetadataCache:
+    def __init__(self, path, ttl=METADATA_CACHE_TTL, max_entries=METADATA_CACHE_MAX_ENTRIES,
+                 max_bytes=METADATA_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                cover_image_url TEXT NOT NULL,
+                last_media_url TEXT NOT NULL,
+                media_definitions TEXT NOT NULL,
+                video_data TEXT,
+                size INTEGER NOT NULL,
+                expires REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS metadata_accessed ON metadata (accessed)")
+        self.connection.commit()
+
+    def get(self, page_url):
+        key = cache_key(page_url)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT title, cover_image_url, last_media_url, media_definitions, video_data, expires "
+                "FROM metadata WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[5] <= now:
+                self.connection.execute("DELETE FROM metadata WHERE key = ?", (key,))
+                self.connection.commit()
+                return None
+            self.connection.execute("UPDATE metadata SET accessed = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+        return {
+            "title": row[0],
+            "cover_image_url": row[1],
+            "last_media_url": row[2],
+            "media_definitions": json.loads(row[3]),
+            "video_data": json.loads(row[4]) if row[4] else None,
+        }
+
+    def store_page(self, page_url, title, cover_image_url, last_media_url, media_definitions):
+        media_json = json.dumps(media_definitions)
+        expires = media_expiry(media_urls(media_definitions), self.ttl)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, NULL, ?, ?, ?)",
+                (cache_key(page_url), title, cover_image_url, last_media_url, media_json,
+                 len(media_json) + len(title) + len(cover_image_url) + len(last_media_url), expires, now),
+            )
+            self.evict()
+            self.connection.commit()
+
+    def store_video_data(self, page_url, video_data):
+        video_json = json.dumps(video_data)
+        expires = media_expiry(media_urls(video_data), self.ttl)
+        with self.lock:
+            self.connection.execute(
+                "UPDATE metadata SET video_data = ?, size = size + ?, expires = MIN(expires, ?) WHERE key = ?",
+                (video_json, len(video_json), expires, cache_key(page_url)),
+            )
+            self.evict()
+            self.connection.commit()
+
+    def invalidate(self, page_url):
+        with self.lock:
+            self.connection.execute("DELETE FROM metadata WHERE key = ?", (cache_key(page_url),))
+            self.connection.commit()
+
+    def evict(self):
+        # Caller holds the lock; drop expired rows, then least recently used ones
+        self.connection.execute("DELETE FROM metadata WHERE expires <= ?", (time.time(),))
+        count, total = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM metadata").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        rows = self.connection.execute("SELECT key, size FROM metadata ORDER BY accessed").fetchall()
+        stale = []
+        for key, size in rows:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            stale.append((key,))
+            count -= 1
+            total -= size
+        self.connection.executemany("DELETE FROM metadata WHERE key = ?", stale)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def cache_key(page_url):
+    # Watch pages are identified by their viewkey, whatever else is in the URL
+    viewkey = parse_qs(urlparse(page_url).query).get("viewkey")
+    return f"viewkey:{viewkey[0]}" if viewkey else page_url
+
+def media_urls(media_definitions):
+    return [media.get("videoUrl", "") for media in media_definitions if isinstance(media, dict)]
+
+def media_expiry(urls, ttl):
+    # Signed media URLs carry their own deadline in validto
+    expires = time.time() + ttl
+    for url in urls:
+        valid_to = parse_qs(urlparse(url.replace("\\/", "/")).query).get("validto")
+        if valid_to and valid_to[0].isdigit():
+            expires = min(expires, int(valid_to[0]) - MEDIA_EXPIRY_MARGIN)
+    return expires
+
+class DownloadIndex:
+    # Completed files by video and quality, plus the transfers running right now
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.inflight = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                video_id TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                checksum TEXT NOT NULL,
+                completed REAL NOT NULL,
+                PRIMARY KEY (video_id, quality)
+            )
+        """)
+        self.connection.commit()
+
+    def completed(self, video_id, quality):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT path, size, checksum FROM downloads WHERE video_id = ? AND quality = ?",
+                (video_id, str(quality)),
+            ).fetchone()
+            if row is None:
+                return None
+            # A file that was moved, deleted or cut short no longer counts
+            if not os.path.isfile(row[0]) or os.path.getsize(row[0]) != row[1]:
+                self.connection.execute(
+                    "DELETE FROM downloads WHERE video_id = ? AND quality = ?", (video_id, str(quality))
+                )
+                self.connection.commit()
+                return None
+        return {"path": row[0], "size": row[1], "checksum": row[2]}
+
+    def begin(self, video_id, quality, owner=None):
+        # The first caller owns the transfer, later ones get the same object to attach to
+        key = (video_id, str(quality))
+        with self.lock:
+            transfer = self.inflight.get(key)
+            if transfer is None:
+                transfer = self.inflight[key] = SharedTransfer(self, key, owner)
+                return transfer, True
+        return transfer, transfer.owner is owner and owner is not None
+
+    def record(self, key, path):
+        # The download already hashed what it wrote, only other files are read again
+        checksum = manifest_checksum(path) or file_checksum(path)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?)",
+                (key[0], key[1], path, os.path.getsize(path), checksum, time.time()),
+            )
+            self.connection.commit()
+
+    def release(self, key, transfer):
+        with self.lock:
+            if self.inflight.get(key) is transfer:
+                del self.inflight[key]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class SessionStore:
+    # The download list between runs; updates are batched so progress costs one transaction per flush
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.pending = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                id INTEGER PRIMARY KEY,
+                page_url TEXT NOT NULL,
+                title TEXT NOT NULL DEFAULT '',
+                cover_image_url TEXT NOT NULL DEFAULT '',
+                quality TEXT,
+                state TEXT NOT NULL DEFAULT 'queued',
+                status TEXT NOT NULL DEFAULT '',
+                filename TEXT,
+                downloaded INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.connection.commit()
+
+    def add(self, page_url):
+        with self.lock:
+            # Committed with the next flush, like every other change
+            return self.connection.execute("INSERT INTO items (page_url) VALUES (?)", (page_url,)).lastrowid
+
+    def update(self, item_id, **fields):
+        # Only the latest value of each field survives until the next flush
+        unknown = set(fields) - set(SESSION_FIELDS)
+        if unknown:
+            raise KeyError(f"Unknown session fields: {', '.join(sorted(unknown))}")
+        with self.lock:
+            self.pending.setdefault(item_id, {}).update(fields)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            for item_id, fields in pending.items():
+                columns = ", ".join(f"{name} = ?" for name in fields)
+                self.connection.execute(f"UPDATE items SET {columns} WHERE id = ?", (*fields.values(), item_id))
+            self.connection.commit()
+
+    def load(self):
+        columns = ("id", "page_url") + SESSION_FIELDS
+        with self.lock:
+            rows = self.connection.execute(f"SELECT {', '.join(columns)} FROM items ORDER BY id").fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+class SharedTransfer:
+    # One running download that duplicate items follow instead of starting their own
+    def __init__(self, index, key, owner=None):
+        self.index = index
+        self.key = key
+        self.owner = owner
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.done = threading.Event()
+        self.filename = None
+        self.error = None
+
+    def attach(self, on_progress=None, on_finished=None, on_error=None):
+        with self.lock:
+            if not self.done.is_set():
+                self.listeners.append((on_progress, on_finished, on_error))
+                return
+        # Already over, report the outcome straight away
+        if self.error is None:
+            if on_finished:
+                on_finished(self.filename)
+        elif on_error:
+            on_error(self.error)
+
+    def progress(self, stats):
+        with self.lock:
+            listeners = list(self.listeners)
+        for on_progress, on_finished, on_error in listeners:
+            if on_progress:
+                on_progress(stats)
+
+    def finish(self, filename):
+        self.index.record(self.key, filename)
+        self.settle(filename, None)
+
+    def fail(self, message):
+        self.settle(None, message)
+
+    def settle(self, filename, error):
+        with self.lock:
+            if self.done.is_set():
+                return
+            self.filename = filename
+            self.error = error
+            listeners = self.listeners
+            self.listeners = []
+            self.done.set()
+        self.index.release(self.key, self)
+        for on_progress, on_finished, on_error in listeners:
+            if error is None and on_finished:
+                on_finished(filename)
+            elif error is not None and on_error:
+                on_error(error)
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise TransferFailed(self.error)
+        return self.filename
+
+def file_checksum(path):
+    # Same value BlockHasher builds while downloading, computed by reading the file once
+    digests = []
+    with open(path, "rb") as data_file:
+        for block in iter(lambda: data_file.read(HASH_BLOCK_SIZE), b""):
+            digests.append(hashlib.sha256(block).digest())
+    return hashlib.sha256(b"".join(digests)).hexdigest()
+
+def read_at(fd, offset, length):
+    if hasattr(os, "pread"):
+        parts = []
+        while length:
+            data = os.pread(fd, length, offset)
+            if not data:
+                break
+            parts.append(data)
+            offset += len(data)
+            length -= len(data)
+        return b"".join(parts)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+class BlockHasher:
+    # SHA-256 of every 4 MiB block, then of the block digests, so ranges can land in any order
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blocks = {}  # Block index to [hasher, next offset] while it is written front to back
+        self.digests = {}
+
+    def update(self, offset, view):
+        while view:
+            index = offset // HASH_BLOCK_SIZE
+            block_start = index * HASH_BLOCK_SIZE
+            count = min(len(view), block_start + HASH_BLOCK_SIZE - offset)
+            with self.lock:
+                state = self.blocks.get(index)
+                if state is None and offset == block_start and index not in self.digests:
+                    state = self.blocks[index] = [hashlib.sha256(), offset]
+            # Only the range that started a block ever continues it, so the hashing needs no lock
+            if state is not None and state[1] == offset:
+                state[0].update(view[:count])
+                state[1] += count
+                if state[1] == block_start + HASH_BLOCK_SIZE:
+                    with self.lock:
+                        self.digests[index] = state[0].digest()
+                        del self.blocks[index]
+            offset += count
+            view = view[count:]
+
+    def hexdigest(self, fd, size):
+        # Blocks split between two ranges or left from an earlier run are read back from the file
+        digests = []
+        for index in range((size + HASH_BLOCK_SIZE - 1) // HASH_BLOCK_SIZE):
+            start = index * HASH_BLOCK_SIZE
+            length = min(HASH_BLOCK_SIZE, size - start)
+            state = self.blocks.get(index)
+            if index in self.digests:
+                digests.append(self.digests[index])
+            elif state is not None and state[1] == start + length:
+                digests.append(state[0].digest())
+            else:
+                metrics.count("checksum_reread_bytes", length)
+                digests.append(hashlib.sha256(read_at(fd, start, length)).digest())
+        return hashlib.sha256(b"".join(digests)).hexdigest()
+
+manifest_lock = threading.Lock()
+
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory or ".", MANIFEST_NAME), "r", encoding="utf-8") as manifest_file:
+            data = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+    files = data.get("files") if isinstance(data, dict) else None
+    return files if isinstance(files, dict) else {}
+
+def record_manifest(filename, checksum):
+    # One manifest per download directory, keyed by file name
+    directory, name = os.path.split(filename)
+    path = os.path.join(directory or ".", MANIFEST_NAME)
+    with manifest_lock:
+        files = load_manifest(directory)
+        files[name] = {
+            "size": os.path.getsize(filename),
+            "checksum": checksum,
+            "algorithm": CHECKSUM_ALGORITHM,
+            "recorded": time.time(),
+        }
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump({"version": 1, "files": files}, manifest_file, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+
+def manifest_checksum(filename):
+    directory, name = os.path.split(filename)
+    entry = load_manifest(directory).get(name)
+    if entry and entry.get("algorithm") == CHECKSUM_ALGORITHM and entry.get("size") == os.path.getsize(filename):
+        return entry.get("checksum")
+    return None
+
+def verify_file(directory, name, entry):
+    path = os.path.join(directory, name)
+    result = {"file": path, "status": "ok"}
+    try:
+        size = os.path.getsize(path)
+        if size != entry.get("size"):
+            result.update(status="size_mismatch", expected=entry.get("size"), actual=size)
+        elif entry.get("algorithm") != CHECKSUM_ALGORITHM:
+            result.update(status="unknown_algorithm", algorithm=entry.get("algorithm"))
+        elif file_checksum(path) != entry.get("checksum"):
+            result.update(status="checksum_mismatch")
+    except FileNotFoundError:
+        result["status"] = "missing"
+    except OSError as e:
+        result.update(status="error", error=str(e))
+    return result
+
+def verify_library(root, workers=VERIFY_WORKERS):
+    # Every manifest under root, files checked in parallel; hashlib drops the GIL while it hashes
+    jobs = []
+    for directory, _, names in os.walk(root):
+        if MANIFEST_NAME in names:
+            jobs.extend((directory, name, entry) for name, entry in sorted(load_manifest(directory).items()))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(verify_file, *job) for job in jobs]
+        for future in futures:
+            yield future.result()
@@ -1,465 +1,1130 @@
 import os
-import re
-import json
-import requests
-from bs4 import BeautifulSoup
-from PyQt5 import QtWidgets, QtCore, QtGui
 import sys
+import time
+import hashlib
+import threading
+import importlib.util
+from collections import OrderedDict, deque
+from PyQt5 import QtWidgets, QtCore, QtGui
 
-class DownloadItem(QtWidgets.QWidget):
-    def __init__(self, page_url, headers, cookies, parent=None):
+def lazy_import(name):
+    # The module runs on first attribute access, so the window can paint before the network stack loads
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+core = lazy_import("core")
+requests = lazy_import("requests")
+json = lazy_import("json")
+
+STAGE_CONCURRENCY = {"listing": 2, "metadata": 4, "thumbnail": 4, "transfer": 3}
+SHUTDOWN_TIMEOUT_MS = 5000
+THUMBNAIL_HEIGHT = 120
+THUMBNAIL_MEMORY_ITEMS = 256
+THUMBNAIL_QUALITY = 90
+THUMBNAIL_WIDTH = THUMBNAIL_HEIGHT * 16 // 9
+ROW_HEIGHT = THUMBNAIL_HEIGHT + 30
+BUTTON_HEIGHT = 26
+RECORD_ROLE = QtCore.Qt.UserRole + 1
+DEBUG_REFRESH_MS = 1000
+STATUS_MESSAGE_MS = 8000
+SESSION_FLUSH_MS = 2000
+RESTORE_INTERVAL_MS = 1000
+RESTORE_PER_TICK = 2
+MEDIA_REFRESH_LIMIT = 3
+MAX_SEGMENTS = 16
+FONT_FILES = ("Poppins-Medium.ttf", "Poppins-SemiBold.ttf")
+STARTUP_TRACE_ENV = "PORNLAND_STARTUP_TRACE"
+
+class DownloadRecord:
+    # Everything the list needs to paint one row, kept as plain data
+    __slots__ = (
+        "page_url", "title", "status", "cover_image_url", "cover_text", "thumbnail", "thumbnail_requested",
+        "quality_labels", "quality_index", "quality_enabled", "download_enabled", "state", "finished", "percent",
+        "speed",
+    )
+
+    def __init__(self, page_url):
+        self.page_url = page_url
+        self.title = "Finding video title..."
+        self.status = "Status: Initializing..."
+        self.cover_image_url = ""
+        self.cover_text = ""
+        self.thumbnail = None
+        self.thumbnail_requested = False
+        self.quality_labels = []
+        self.quality_index = -1
+        self.quality_enabled = False
+        self.download_enabled = False
+        self.state = "active"
+        self.finished = False
+        self.percent = 0
+        self.speed = ""
+
+class DownloadItem(QtCore.QObject):
+    def __init__(self, page_url, client, scheduler, model, metadata_cache=None, thumbnail_cache=None,
+                 download_index=None, segments=None, remux=None, priority=0, refresh_expired=True,
+                 policy=None, session=None, entry=None, parent=None):
         super().__init__(parent)
         self.page_url = page_url
-        self.headers = headers
-        self.cookies = cookies
+        self.client = client
+        self.scheduler = scheduler
+        self.model = model
+        self.metadata_cache = metadata_cache
+        self.thumbnail_cache = thumbnail_cache
+        self.download_index = download_index
+        self.transfer = None
+        self.transfer_listener = None
+        self.from_cache = False
+        self.media_definitions = []
+        self.segments = segments or core.DEFAULT_SEGMENTS
+        self.remux = remux
+        self.refresh_expired = refresh_expired
+        self.policy = policy
+        self.awaiting_sizes = False
+        self.resume_quality = None
+        self.media_refreshes = 0
+        self.session = session
+        self.session_id = None
+        self.pending_restore = False
+        self.job = DownloadJob(page_url, priority)
+        self.job.task_started.connect(self.on_task_started)
+        self.job.state_changed.connect(self.on_job_state_changed)
+        self.download_quality = None
         self.video_title = "video"
         self.last_media_url = ""
         self.cover_image_url = ""
         self.video_data = []
         self.quality_options = []
+        self.quality_sizes = []
         self.selected_quality_url = None
-        self.init_ui()
+        self.record = DownloadRecord(page_url)
+        self.row = -1
+        self.model.add_item(self)
+        if entry:
+            self.load_entry(entry)
+            return
+        if self.session:
+            self.session_id = self.session.add(page_url)
         self.start_find()
 
-    def init_ui(self):
-        main_layout = QtWidgets.QVBoxLayout()
-        main_layout.setSpacing(5)
-        main_layout.setContentsMargins(10, 10, 10, 10)
-
-        # Cover Image Label
-        self.cover_image_label = QtWidgets.QLabel(self)
-        self.cover_image_label.setFixedHeight(120)  # Adjust height as needed
-        self.cover_image_label.setAlignment(QtCore.Qt.AlignCenter)
-        self.cover_image_label.setStyleSheet("background-color: #1E1E1E; border-radius: 5px;")
-        main_layout.addWidget(self.cover_image_label)
-
-        # Title Label
-        self.title_label = QtWidgets.QLabel("Finding video title...", self)
-        font = QtGui.QFont("Poppins SemiBold", 10)
-        self.title_label.setFont(font)
-        main_layout.addWidget(self.title_label)
-
-        # Control Layout
-        control_layout = QtWidgets.QHBoxLayout()
-        control_layout.setSpacing(10)
-
-        self.quality_combo = QtWidgets.QComboBox(self)
-        self.quality_combo.setEnabled(False)
-        self.quality_combo.setMinimumWidth(100)
-        control_layout.addWidget(self.quality_combo)
-
-        self.download_button = QtWidgets.QPushButton("Download", self)
-        self.download_button.setEnabled(False)
-        self.download_button.clicked.connect(self.download_video)
-        control_layout.addWidget(self.download_button)
-
-        main_layout.addLayout(control_layout)
-
-        # Status Label
-        self.status_label = QtWidgets.QLabel("Status: Initializing...", self)
-        self.status_label.setFont(QtGui.QFont("Poppins Medium", 9))
-        main_layout.addWidget(self.status_label)
-
-        # Progress Layout
-        progress_layout = QtWidgets.QHBoxLayout()
-        progress_layout.setContentsMargins(0, 0, 0, 0)
-        progress_layout.setSpacing(5)
-
-        self.progress_bar = QtWidgets.QProgressBar(self)
-        self.progress_bar.setValue(0)
-        self.progress_bar.setTextVisible(False)
-        self.progress_bar.setStyleSheet("""
-            QProgressBar {
-                border: 2px solid #FFA500;
-                border-radius: 5px;
-                background-color: #333333;
-            }
-            QProgressBar::chunk {
-                background-color: #FFA500;
-                width: 20px;
-            }
-        """)
-        self.progress_bar.setFixedHeight(20)
-        progress_layout.addWidget(self.progress_bar, stretch=1)
-
-        self.progress_label = QtWidgets.QLabel("0%", self)
-        self.progress_label.setAlignment(QtCore.Qt.AlignCenter)
-        self.progress_label.setStyleSheet("color: #FFA500;")
-        self.progress_label.setFont(QtGui.QFont("Poppins Medium", 9))
-        self.progress_label.setFixedWidth(50)
-        progress_layout.addWidget(self.progress_label)
-
-        progress_layout.addStretch()
-
-        main_layout.addLayout(progress_layout)
-
-        self.setLayout(main_layout)
-        self.setStyleSheet("""
-            QWidget {
-                background-color: #121212;
-                border: 1px solid #444444;
-                border-radius: 5px;
-            }
-            QLabel {
-                color: #FFFFFF;
-                font-family: "Poppins";
-                font-weight: 500;
-            }
-            QComboBox {
-                padding: 5px;
-                border: 1px solid #FFA500;
-                border-radius: 3px;
-                background-color: #1E1E1E;
-                color: #FFFFFF;
-                font-family: "Poppins";
-                font-weight: 500;
-            }
-            QPushButton {
-                background-color: #FFA500;
-                color: #1B1B1B;
-                border: none;
-                padding: 5px 15px;
-                border-radius: 3px;
-                font-family: "Poppins";
-                font-weight: 500;
-            }
-            QPushButton:hover {
-                background-color: #e69500;
-            }
-            QPushButton:disabled {
-                background-color: #666666;
-            }
-        """)
-        self.setFixedHeight(250)  # Adjust height to accommodate image
+    def changed(self):
+        self.model.item_changed(self)
+
+    def save(self, **fields):
+        if self.session and self.session_id is not None:
+            self.session.update(self.session_id, **fields)
+
+    def set_status(self, text):
+        self.record.status = text
+        self.save(status=text)
+        self.changed()
+
+    def load_entry(self, entry):
+        # A restored row paints from what was stored; the network waits until restore()
+        self.session_id = entry["id"]
+        if entry["title"]:
+            self.video_title = entry["title"]
+            self.record.title = f"Title: {entry['title']}"
+        self.cover_image_url = entry["cover_image_url"]
+        self.show_cover(self.cover_image_url)
+        if entry["quality"]:
+            self.download_quality = entry["quality"]
+            self.record.quality_labels = [f"{entry['quality']}p"]
+            self.record.quality_index = 0
+        if entry["total"]:
+            self.record.percent = min(100, entry["downloaded"] * 100 // entry["total"])
+        self.record.status = entry["status"] or self.record.status
+        if entry["state"] == "finished":
+            self.record.finished = True
+            self.record.percent = 100
+        elif entry["state"] == "paused":
+            self.pending_restore = True
+            self.job.set_state("paused")
+        elif entry["state"] == "cancelled":
+            self.job.set_state("cancelled")
+        else:
+            # Queued and running items are restored by the window a few at a time, failed ones on a click
+            self.pending_restore = True
+            self.record.download_enabled = entry["state"] == "failed"
+        self.changed()
+
+    def restore(self):
+        # Resolve again; a download that was under way picks up the same quality from its journal
+        self.pending_restore = False
+        self.resume_quality = self.download_quality
+        self.set_status("Status: Restoring...")
+        self.start_find()
 
     def start_find(self):
-        self.find_thread = QtCore.QThread()
-        self.find_worker = FindWorker(self.page_url, self.headers, self.cookies)
-        self.find_worker.moveToThread(self.find_thread)
-
-        self.find_thread.started.connect(self.find_worker.run)
-        self.find_worker.finished.connect(self.on_find_finished)
-        self.find_worker.error.connect(self.on_error)
-
-        self.find_worker.finished.connect(self.find_thread.quit)
-        self.find_worker.finished.connect(self.find_worker.deleteLater)
-        self.find_thread.finished.connect(self.find_thread.deleteLater)
-
-        self.find_thread.start()
-
-    def on_find_finished(self, media_definitions, video_title, last_media_url, cover_image_url):
+        entry = self.metadata_cache.get(self.page_url) if self.metadata_cache else None
+        if entry:
+            self.load_cached(entry)
+            return
+        self.scheduler.submit(self.job, "metadata", self.create_find_worker)
+
+    def load_cached(self, entry):
+        self.from_cache = True
+        self.video_title = entry["title"]
+        self.last_media_url = entry["last_media_url"]
+        self.cover_image_url = entry["cover_image_url"]
+        self.media_definitions = entry["media_definitions"]
+        self.record.title = f"Title: {self.video_title}"
+        self.save(title=self.video_title, cover_image_url=self.cover_image_url)
+        self.show_cover(self.cover_image_url)
+
+        if entry["video_data"]:
+            self.show_quality_options(entry["video_data"])
+        else:
+            self.set_status("Status: Fetching video data...")
+            self.scheduler.submit(self.job, "metadata", self.create_video_data_worker)
+
+    def on_media_expired(self):
+        if self.transfer:
+            self.transfer.fail("Media link expired.")
+            self.transfer = None
+        if self.refresh_expired and self.media_refreshes < MEDIA_REFRESH_LIMIT:
+            if self.resume_quality is None and self.download_quality is not None:
+                # Expired mid-transfer, fetch fresh signed URLs and continue the same quality from the journal
+                self.media_refreshes += 1
+                self.resume_quality = self.download_quality
+                self.set_status("Status: Media link expired, refreshing it...")
+                self.scheduler.submit(self.job, "metadata", self.create_video_data_worker)
+                return
+            if self.resume_quality is not None:
+                # The video data link expired as well, fall back to the watch page
+                self.media_refreshes += 1
+                self.from_cache = True
+        # Signed URLs from the cache went stale, resolve the page again
+        if not self.from_cache:
+            self.resume_quality = None
+            self.on_error("Media link expired.")
+            return
+        if self.metadata_cache:
+            self.metadata_cache.invalidate(self.page_url)
+        self.from_cache = False
+        self.quality_options = []
+        self.quality_sizes = []
+        self.selected_quality_url = None
+        self.record.quality_labels = []
+        self.record.quality_index = -1
+        self.record.quality_enabled = False
+        self.record.download_enabled = False
+        self.set_status("Status: Media link expired, resolving again...")
+        self.scheduler.submit(self.job, "metadata", self.create_find_worker)
+
+    def create_find_worker(self):
+        worker = FindWorker(self.page_url, self.client)
+        worker.resolved.connect(self.on_page_resolved)
+        worker.finished.connect(self.on_video_data_fetched)
+        worker.error.connect(self.on_error)
+        worker.expired.connect(self.on_media_expired)
+        return worker
+
+    def on_page_resolved(self, media_definitions, video_title, last_media_url, cover_image_url):
         self.video_title = video_title
         self.last_media_url = last_media_url
         self.cover_image_url = cover_image_url
-        self.title_label.setText(f"Title: {self.video_title}")
-
-        if self.cover_image_url:
-            self.fetch_cover_image(self.cover_image_url)
-        else:
-            self.cover_image_label.setText("No Cover Image Found")
-
-        if not self.last_media_url:
-            self.status_label.setText("Status: Last media URL not found.")
+        self.media_definitions = media_definitions
+        self.record.title = f"Title: {self.video_title}"
+        self.save(title=video_title, cover_image_url=cover_image_url)
+        if self.metadata_cache:
+            self.metadata_cache.store_page(self.page_url, video_title, cover_image_url, last_media_url, media_definitions)
+        # The row repaints now and the delegate asks for the cover while the video data loads
+        self.show_cover(self.cover_image_url)
+        self.set_status("Status: Fetching video data...")
+
+    def create_video_data_worker(self):
+        worker = VideoDataWorker(self.last_media_url, self.client)
+        worker.finished.connect(self.on_video_data_fetched)
+        worker.error.connect(self.on_error)
+        worker.expired.connect(self.on_media_expired)
+        return worker
+
+    def show_cover(self, image_url):
+        # The image itself is fetched once the row is painted, see request_thumbnail
+        self.record.cover_image_url = image_url
+        self.record.cover_text = "" if image_url else "No Cover Image Found"
+        self.changed()
+
+    def request_thumbnail(self):
+        if self.record.thumbnail_requested or not self.cover_image_url:
             return
-
-        self.status_label.setText("Status: Fetching video data...")
-
-        self.video_data_thread = QtCore.QThread()
-        self.video_data_worker = VideoDataWorker(self.last_media_url, self.headers, self.cookies)
-        self.video_data_worker.moveToThread(self.video_data_thread)
-
-        self.video_data_thread.started.connect(self.video_data_worker.run)
-        self.video_data_worker.finished.connect(self.on_video_data_fetched)
-        self.video_data_worker.error.connect(self.on_error)
-
-        self.video_data_worker.finished.connect(self.video_data_thread.quit)
-        self.video_data_worker.finished.connect(self.video_data_worker.deleteLater)
-        self.video_data_thread.finished.connect(self.video_data_thread.deleteLater)
-
-        self.video_data_thread.start()
+        self.record.thumbnail_requested = True
+        self.fetch_cover_image(self.cover_image_url)
 
     def fetch_cover_image(self, image_url):
-        self.image_fetch_thread = QtCore.QThread()
-        self.image_fetch_worker = ImageFetchWorker(image_url)
-        self.image_fetch_worker.moveToThread(self.image_fetch_thread)
-
-        self.image_fetch_thread.started.connect(self.image_fetch_worker.run)
-        self.image_fetch_worker.finished.connect(self.on_image_fetched)
-        self.image_fetch_worker.error.connect(self.on_error)
-
-        self.image_fetch_worker.finished.connect(self.image_fetch_thread.quit)
-        self.image_fetch_worker.finished.connect(self.image_fetch_worker.deleteLater)
-        self.image_fetch_thread.finished.connect(self.image_fetch_thread.deleteLater)
-
-        self.image_fetch_thread.start()
-
-    def on_image_fetched(self, image_data):
-        pixmap = QtGui.QPixmap()
-        pixmap.loadFromData(image_data)
-        if not pixmap.isNull():
-            # Scale pixmap to fit the label while maintaining aspect ratio
-            scaled_pixmap = pixmap.scaled(self.cover_image_label.size(), QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
-            self.cover_image_label.setPixmap(scaled_pixmap)
+        image = self.thumbnail_cache.get_memory(image_url, THUMBNAIL_HEIGHT) if self.thumbnail_cache else None
+        if image is not None:
+            self.on_image_fetched(image)
+            return
+        self.scheduler.submit(self.job, "thumbnail", lambda: self.create_image_fetch_worker(image_url))
+
+    def create_image_fetch_worker(self, image_url):
+        worker = ImageFetchWorker(image_url, self.client, THUMBNAIL_HEIGHT, self.thumbnail_cache)
+        worker.finished.connect(self.on_image_fetched)
+        worker.error.connect(self.on_cover_error)
+        return worker
+
+    def on_image_fetched(self, image):
+        # The worker already decoded and scaled it, the delegate draws it as is
+        if not image.isNull():
+            self.record.thumbnail = image
         else:
-            self.cover_image_label.setText("Failed to load image.")
+            self.record.cover_text = "Failed to load image."
+        self.changed()
 
-    def on_video_data_fetched(self, video_data):
-        self.video_data = video_data
-        self.quality_options = []
+    def on_cover_error(self, message):
+        # Only the thumbnail failed, the download and its status are left alone
+        self.record.cover_text = "Failed to load image."
+        self.changed()
 
-        for media in video_data:
-            quality = media.get("quality")
-            video_url = media.get("videoUrl", "").replace("\\/", "/")
-            if quality and video_url:
-                self.quality_options.append((quality, video_url))
-                self.quality_combo.addItem(f"{quality}p")
+    def on_video_data_fetched(self, video_data):
+        if self.metadata_cache:
+            self.metadata_cache.store_video_data(self.page_url, video_data)
+        self.show_quality_options(video_data)
 
+    def show_quality_options(self, video_data):
+        self.video_data = video_data
+        self.quality_options = core.quality_options(video_data, self.media_definitions)
+        self.quality_sizes = []
+        self.record.quality_labels = [core.quality_label(quality, url) for quality, url in self.quality_options]
+        self.record.quality_index = -1
         if self.quality_options:
-            self.quality_combo.setEnabled(True)
-            self.status_label.setText("Status: Select quality and download.")
-            self.quality_combo.currentIndexChanged.connect(self.on_quality_selected)
+            options = list(self.quality_options)
+            self.scheduler.submit(self.job, "metadata", lambda: self.create_size_probe_worker(options))
+
+        # Compared as text, restored sessions store the quality as a string
+        qualities = [str(quality) for quality, url in self.quality_options]
+        if self.resume_quality is not None and str(self.resume_quality) in qualities:
+            index = qualities.index(str(self.resume_quality))
+            self.resume_quality = None
+            self.on_quality_selected(index)
+            self.download_video()
+        elif self.quality_options:
+            self.resume_quality = None
+            self.record.quality_enabled = True
+            # A size cap has to wait for the probes, the other policies can pick right away
+            if self.policy and self.policy["max_size"]:
+                self.awaiting_sizes = True
+                self.set_status("Status: Checking file sizes...")
+            elif self.policy:
+                self.apply_policy()
+            else:
+                self.set_status("Status: Select quality and download.")
         else:
-            self.status_label.setText("Status: No quality options found.")
+            self.set_status("Status: No quality options found.")
+
+    def create_size_probe_worker(self, options):
+        worker = SizeProbeWorker(options, self.client)
+        worker.finished.connect(lambda sizes: self.on_sizes_probed(options, sizes))
+        return worker
+
+    def on_sizes_probed(self, options, sizes):
+        if options != self.quality_options:
+            return  # Resolved again in the meantime
+        self.quality_sizes = sizes
+        self.record.quality_labels = [
+            core.quality_label(quality, url, size) for (quality, url), size in zip(options, sizes)
+        ]
+        self.changed()
+        if self.awaiting_sizes:
+            self.awaiting_sizes = False
+            self.apply_policy()
+
+    def apply_policy(self):
+        choice = core.pick_quality(
+            self.quality_options, self.policy["max_quality"], self.quality_sizes, self.policy["max_size"]
+        )
+        if not choice:
+            self.set_status("Status: No quality matches the auto-select policy, pick one.")
+            return
+        self.on_quality_selected(self.quality_options.index(choice))
+        self.download_video()
 
     def on_quality_selected(self, index):
         if index >= 0 and index < len(self.quality_options):
             self.selected_quality_url = self.quality_options[index][1]
             selected_quality = self.quality_options[index][0]
-            self.status_label.setText(f"Status: {selected_quality}p selected. Click 'Download' to start.")
-            self.download_button.setEnabled(True)
+            self.record.quality_index = index
+            self.record.download_enabled = True
+            self.set_status(f"Status: {selected_quality}p selected. Click 'Download' to start.")
         else:
             self.selected_quality_url = None
-            self.status_label.setText("Status: Invalid quality selection.")
-            self.download_button.setEnabled(False)
+            self.record.download_enabled = False
+            self.set_status("Status: Invalid quality selection.")
 
     def download_video(self):
+        if self.pending_restore:
+            self.restore()
+            return
+        if self.transfer_listener or self.job.has_task("transfer"):
+            return  # Already queued, running, paused or following another item
         if not self.selected_quality_url:
-            self.status_label.setText("Status: No quality selected.")
+            self.set_status("Status: No quality selected.")
             return
 
-        selected_quality = self.quality_options[self.quality_combo.currentIndex()][0]
-
-        self.status_label.setText(f"Status: Downloading {selected_quality}p...")
-        self.download_button.setEnabled(False)
-        self.quality_combo.setEnabled(False)
+        selected_quality = self.quality_options[self.record.quality_index][0]
 
-        self.download_thread = QtCore.QThread()
-        self.download_worker = DownloadWorker(
-            self.selected_quality_url,
-            self.headers,
-            self.cookies,
-            self.video_title,
-            selected_quality
-        )
-        self.download_worker.moveToThread(self.download_thread)
+        self.record.finished = False
+        self.record.download_enabled = False
+        self.record.quality_enabled = False
+        self.download_quality = selected_quality
+        self.save(quality=str(selected_quality), state="downloading")
 
-        self.download_thread.started.connect(self.download_worker.run)
-        self.download_worker.progress.connect(self.update_progress)
-        self.download_worker.finished.connect(self.on_download_finished)
-        self.download_worker.error.connect(self.on_error)
-
-        self.download_worker.finished.connect(self.download_thread.quit)
-        self.download_worker.finished.connect(self.download_worker.deleteLater)
-        self.download_thread.finished.connect(self.download_thread.deleteLater)
-
-        self.download_thread.start()
+        if self.download_index:
+            key = core.cache_key(self.page_url)
+            entry = self.download_index.completed(key, selected_quality)
+            if entry:
+                self.on_download_finished(entry["path"])
+                return
+            self.transfer, owner = self.download_index.begin(key, selected_quality, self)
+            if not owner:
+                self.follow_transfer(self.transfer)
+                return
 
-    def update_progress(self, percent):
-        self.progress_bar.setValue(percent)
-        self.progress_label.setText(f"{percent}%")
+        self.set_status(f"Status: Queued {selected_quality}p for download...")
+        download_url = self.selected_quality_url
+        self.scheduler.submit(self.job, "transfer", lambda: self.create_download_worker(download_url, selected_quality))
+
+    def follow_transfer(self, transfer):
+        # Another item is already fetching this video, mirror its progress instead
+        listener = TransferListener(self)
+        listener.progress.connect(self.on_followed_progress)
+        listener.finished.connect(self.on_followed_finished)
+        listener.error.connect(self.on_followed_error)
+        self.transfer_listener = listener
+        self.set_status("Status: Same video is downloading in another item, following it...")
+        transfer.attach(listener.progress.emit, listener.finished.emit, listener.error.emit)
+
+    def on_followed_progress(self, stats):
+        if self.job.state != "cancelled":
+            self.update_progress(stats)
+
+    def on_followed_finished(self, filename):
+        self.transfer = None
+        self.transfer_listener = None
+        if self.job.state != "cancelled":
+            self.on_download_finished(filename)
+
+    def on_followed_error(self, message):
+        self.transfer = None
+        self.transfer_listener = None
+        if self.job.state != "cancelled":
+            self.on_error(f"Original download failed: {message}")
+
+    def create_download_worker(self, download_url, quality):
+        worker = DownloadWorker(
+            download_url, self.client, self.video_title, quality, self.segments, self.remux, self.transfer,
+            weight=self.job.priority + 1
+        )
+        worker.progress.connect(self.update_progress)
+        worker.finished.connect(self.on_download_finished)
+        worker.error.connect(self.on_error)
+        worker.expired.connect(self.on_media_expired)
+        return worker
+
+    def on_task_started(self, stage):
+        if stage == "transfer":
+            self.set_status(f"Status: Downloading {self.download_quality}p...")
+
+    def toggle_pause(self):
+        if self.record.finished:
+            return
+        if self.job.state == "paused":
+            self.scheduler.resume(self.job)
+            if self.pending_restore:
+                self.restore()
+        else:
+            self.scheduler.pause(self.job)
+
+    def cancel(self):
+        if not self.record.finished:
+            self.scheduler.cancel(self.job)
+
+    def on_job_state_changed(self, state):
+        self.record.state = state
+        if self.record.finished:
+            self.changed()
+            return  # The file is complete, its saved state and status stay as they are
+        if state == "active":
+            self.save(state="downloading" if self.download_quality else "queued")
+        else:
+            self.save(state=state)
+        if state == "paused":
+            self.set_status("Status: Paused")
+        elif state == "cancelled":
+            if self.transfer and self.transfer.owner is self:
+                self.transfer.fail("Cancelled")
+            self.transfer = None
+            self.record.download_enabled = False
+            self.record.quality_enabled = False
+            self.set_status("Status: Cancelled")
+        else:
+            self.set_status("Status: Resumed")
+
+    def update_progress(self, stats):
+        self.record.percent = stats["percent"]
+        self.save(downloaded=stats["downloaded"], total=stats["total"])
+        speed = core.format_size(stats["smoothed_speed"])
+        if stats.get("allotted"):
+            speed = f"{speed}/s of {core.format_size(stats['allotted'])}"
+        if stats["eta"] >= 0:
+            self.record.speed = f"{speed}/s, {core.format_eta(stats['eta'])} left"
+        else:
+            self.record.speed = f"{speed}/s, {core.format_size(stats['downloaded'])} done"
+        self.changed()
 
     def on_download_finished(self, filename):
-        self.status_label.setText(f"Status: Downloaded to {filename}")
-        self.download_button.setEnabled(False)
-        self.quality_combo.setEnabled(True)
-        self.progress_label.setText("100%")
-        self.progress_bar.setValue(100)
+        self.transfer = None
+        self.media_refreshes = 0
+        self.save(state="finished", filename=filename)
+        self.record.finished = True
+        self.record.download_enabled = False
+        self.record.quality_enabled = True
+        self.record.percent = 100
+        self.record.speed = ""
+        self.set_status(f"Status: Downloaded to {filename}")
 
     def on_error(self, message):
-        self.status_label.setText(f"Status: Error - {message}")
-        self.download_button.setEnabled(True)
-        self.quality_combo.setEnabled(True)
-        self.progress_bar.setValue(0)
-        self.progress_label.setText("0%")
+        self.resume_quality = None
+        self.save(state="failed")
+        self.record.download_enabled = True
+        self.record.quality_enabled = True
+        self.record.percent = 0
+        self.record.speed = ""
+        self.set_status(f"Status: Error - {message}")
+
+class DownloadListModel(QtCore.QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.items = []
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        record = self.items[index.row()].record
+        if role == RECORD_ROLE:
+            return record
+        if role == QtCore.Qt.DisplayRole:
+            return record.title
+        if role == QtCore.Qt.ToolTipRole:
+            return record.page_url
+        return None
+
+    def add_item(self, item):
+        row = len(self.items)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self.items.append(item)
+        item.row = row
+        self.endInsertRows()
+
+    def item_changed(self, item):
+        index = self.index(item.row)
+        self.dataChanged.emit(index, index)
+
+class DownloadItemDelegate(QtWidgets.QStyledItemDelegate):
+    action_triggered = QtCore.pyqtSignal(int, str, QtCore.QPoint)
+    thumbnail_needed = QtCore.pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.title_font = QtGui.QFont("Poppins SemiBold", 10)
+        self.text_font = QtGui.QFont("Poppins Medium", 9)
+
+    def sizeHint(self, option, index):
+        return QtCore.QSize(option.rect.width(), ROW_HEIGHT)
+
+    def layout(self, rect):
+        card = rect.adjusted(5, 5, -5, -5)
+        thumbnail = QtCore.QRect(card.left() + 10, card.top() + 10, THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT)
+        left = thumbnail.right() + 15
+        width = max(0, card.right() - 10 - left)
+        rects = {
+            "card": card,
+            "thumbnail": thumbnail,
+            "title": QtCore.QRect(left, thumbnail.top(), width, 22),
+            "status": QtCore.QRect(left, thumbnail.top() + 26, width, 20),
+            "progress": QtCore.QRect(left, thumbnail.top() + 52, max(0, width - 210), 20),
+            "percent": QtCore.QRect(left + max(0, width - 205), thumbnail.top() + 52, 50, 20),
+            "speed": QtCore.QRect(left + max(0, width - 150), thumbnail.top() + 52, 150, 20),
+        }
+        x = left
+        top = thumbnail.bottom() - BUTTON_HEIGHT + 1
+        for name, button_width in (("quality", 110), ("download", 90), ("pause", 90), ("cancel", 90)):
+            rects[name] = QtCore.QRect(x, top, button_width, BUTTON_HEIGHT)
+            x += button_width + 10
+        return rects
+
+    def buttons(self, record):
+        quality = record.quality_labels[record.quality_index] if record.quality_index >= 0 else "Quality"
+        active = record.state != "cancelled" and not record.finished
+        return (
+            ("quality", f"{quality} \u25be", record.quality_enabled),
+            ("download", "Download", record.download_enabled),
+            ("pause", "Resume" if record.state == "paused" else "Pause", active),
+            ("cancel", "Cancel", active),
+        )
+
+    def paint(self, painter, option, index):
+        record = index.data(RECORD_ROLE)
+        rects = self.layout(option.rect)
+        painter.save()
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+
+        painter.setPen(QtGui.QPen(QtGui.QColor("#444444"), 1))
+        painter.setBrush(QtGui.QColor("#121212"))
+        painter.drawRoundedRect(rects["card"], 5, 5)
+
+        # Cover Image, fetched the first time the row becomes visible
+        thumbnail = rects["thumbnail"]
+        painter.setPen(QtCore.Qt.NoPen)
+        painter.setBrush(QtGui.QColor("#1E1E1E"))
+        painter.drawRoundedRect(thumbnail, 5, 5)
+        if record.thumbnail is not None:
+            image = record.thumbnail
+            if image.width() > thumbnail.width():
+                source = QtCore.QRect((image.width() - thumbnail.width()) // 2, 0, thumbnail.width(), image.height())
+                painter.drawImage(thumbnail.topLeft(), image, source)
+            else:
+                painter.drawImage(thumbnail.left() + (thumbnail.width() - image.width()) // 2, thumbnail.top(), image)
+        else:
+            painter.setPen(QtGui.QColor("#FFFFFF"))
+            painter.setFont(self.text_font)
+            painter.drawText(thumbnail, QtCore.Qt.AlignCenter, record.cover_text)
+            if record.cover_image_url and not record.thumbnail_requested:
+                self.thumbnail_needed.emit(index.row())
+
+        painter.setPen(QtGui.QColor("#FFFFFF"))
+        painter.setFont(self.title_font)
+        self.draw_elided(painter, rects["title"], record.title)
+        painter.setFont(self.text_font)
+        self.draw_elided(painter, rects["status"], record.status)
+
+        progress = rects["progress"]
+        painter.setPen(QtGui.QPen(QtGui.QColor("#FFA500"), 2))
+        painter.setBrush(QtGui.QColor("#333333"))
+        painter.drawRoundedRect(progress.adjusted(1, 1, -1, -1), 5, 5)
+        if record.percent > 0:
+            chunk = progress.adjusted(3, 3, -3, -3)
+            chunk.setWidth(chunk.width() * record.percent // 100)
+            painter.setPen(QtCore.Qt.NoPen)
+            painter.setBrush(QtGui.QColor("#FFA500"))
+            painter.drawRect(chunk)
+        painter.setPen(QtGui.QColor("#FFA500"))
+        painter.drawText(rects["percent"], QtCore.Qt.AlignCenter, f"{record.percent}%")
+        self.draw_elided(painter, rects["speed"], record.speed)
+
+        for name, label, enabled in self.buttons(record):
+            painter.setPen(QtCore.Qt.NoPen)
+            painter.setBrush(QtGui.QColor("#FFA500" if enabled else "#666666"))
+            painter.drawRoundedRect(rects[name], 3, 3)
+            painter.setPen(QtGui.QColor("#1B1B1B"))
+            painter.drawText(rects[name], QtCore.Qt.AlignCenter, label)
+
+        painter.restore()
+
+    def draw_elided(self, painter, rect, text):
+        text = painter.fontMetrics().elidedText(text, QtCore.Qt.ElideRight, rect.width())
+        painter.drawText(rect, QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter, text)
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() != QtCore.QEvent.MouseButtonRelease or event.button() != QtCore.Qt.LeftButton:
+            return False
+        record = index.data(RECORD_ROLE)
+        rects = self.layout(option.rect)
+        for name, label, enabled in self.buttons(record):
+            if enabled and rects[name].contains(event.pos()):
+                self.action_triggered.emit(index.row(), name, event.globalPos())
+                return True
+        return False
 
 class FindWorker(QtCore.QObject):
-    finished = QtCore.pyqtSignal(list, str, str, str)  # Added cover_image_url
+    resolved = QtCore.pyqtSignal(list, str, str, str)  # Added cover_image_url
+    finished = QtCore.pyqtSignal(list)
     error = QtCore.pyqtSignal(str)
+    expired = QtCore.pyqtSignal()
 
-    def __init__(self, page_url, headers, cookies):
+    def __init__(self, page_url, client):
         super().__init__()
         self.page_url = page_url
-        self.headers = headers
-        self.cookies = cookies
+        self.client = client
 
     def run(self):
         try:
-            response = requests.get(self.page_url, headers=self.headers, cookies=self.cookies)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            player_div = soup.find(id="player")
-            if not player_div:
-                self.error.emit("#player div not found.")
-                return
-
-            # Extract Cover Image URL
-            img_tag = player_div.find('img')
-            if img_tag and img_tag.get('src'):
-                cover_image_url = img_tag['src'].replace("\\/", "/")
-            else:
-                cover_image_url = ""
-
-            script_tag = None
-            for script in player_div.find_all('script'):
-                if re.search(r'flashvars_\d+', script.text):
-                    script_tag = script
-                    break
-
-            if not script_tag:
-                self.error.emit("No matching script with flashvars found in #player.")
-                return
-
-            json_text = re.search(r'flashvars_\d+\s*=\s*(\{.*?\});', script_tag.string, re.DOTALL)
-            if not json_text:
-                self.error.emit("flashvars JSON data not found.")
-                return
-
-            try:
-                flashvars_data = json.loads(json_text.group(1))
-            except json.JSONDecodeError as e:
-                self.error.emit(f"JSON parsing error: {e}")
-                return
-
-            media_definitions = flashvars_data.get('mediaDefinitions')
-            if not media_definitions:
-                self.error.emit("No mediaDefinitions found in flashvars.")
-                return
-
-            last_media = media_definitions[-1]
-            if not last_media.get("remote", False):
-                self.error.emit("Last media item does not have remote:true.")
-                return
-
-            last_media_url = last_media.get("videoUrl", "").replace("\\/", "/")
-            if not last_media_url:
-                self.error.emit("Last media URL not found.")
-                return
-
-            video_title_tag = soup.select_one(".video-wrapper .title .inlineFree")
-            video_title = video_title_tag.text.strip().replace(" ", " ") if video_title_tag else "video"
-
-            self.finished.emit(media_definitions, video_title, last_media_url, cover_image_url)
+            media_definitions, video_title, last_media_url, cover_image_url = core.resolve_page(self.client, self.page_url)
+            # Title and cover go out now, the video data follows on this thread without queueing again
+            self.resolved.emit(media_definitions, video_title, last_media_url, cover_image_url)
+            self.finished.emit(core.fetch_video_data(self.client, last_media_url))
+        except core.MediaExpired:
+            self.expired.emit()
+        except core.ResolveError as e:
+            self.error.emit(str(e))
         except requests.RequestException as e:
             self.error.emit(f"HTTP request error: {e}")
+        except json.JSONDecodeError as e:
+            self.error.emit(f"JSON decoding error: {e}")
 
 class VideoDataWorker(QtCore.QObject):
     finished = QtCore.pyqtSignal(list)
     error = QtCore.pyqtSignal(str)
+    expired = QtCore.pyqtSignal()
 
-    def __init__(self, video_url, headers, cookies):
+    def __init__(self, video_url, client):
         super().__init__()
         self.video_url = video_url
-        self.headers = headers
-        self.cookies = cookies
+        self.client = client
 
     def run(self):
         try:
-            response = requests.get(self.video_url, headers=self.headers, cookies=self.cookies)
-            response.raise_for_status()
-            video_data = response.json()
-            self.finished.emit(video_data)
+            self.finished.emit(core.fetch_video_data(self.client, self.video_url))
+        except core.MediaExpired:
+            self.expired.emit()
         except requests.RequestException as e:
             self.error.emit(f"Error fetching video data: {e}")
         except json.JSONDecodeError as e:
             self.error.emit(f"JSON decoding error: {e}")
 
+class ListingWorker(QtCore.QObject):
+    found = QtCore.pyqtSignal(list)
+    finished = QtCore.pyqtSignal(int)
+    error = QtCore.pyqtSignal(str)
+    stopped = QtCore.pyqtSignal()
+
+    def __init__(self, listing_url, client):
+        super().__init__()
+        # Every page's videos go out as soon as that page is parsed
+        self.crawler = core.ListingCrawler(client, listing_url, self.found.emit)
+
+    def cancel(self):
+        self.crawler.cancel()
+
+    def run(self):
+        try:
+            found = self.crawler.run()
+            if self.crawler.cancel_event.is_set():
+                self.stopped.emit()
+            else:
+                self.finished.emit(found)
+        except core.ResolveError as e:
+            self.error.emit(str(e))
+        except requests.RequestException as e:
+            self.error.emit(f"HTTP request error: {e}")
+        except ValueError as e:
+            self.error.emit(f"Could not parse the listing page: {e}")
+
+class SizeProbeWorker(QtCore.QObject):
+    finished = QtCore.pyqtSignal(list)
+
+    def __init__(self, options, client):
+        super().__init__()
+        self.options = options
+        self.client = client
+
+    def run(self):
+        self.finished.emit(core.probe_sizes(self.client, self.options))
+
 class DownloadWorker(QtCore.QObject):
-    progress = QtCore.pyqtSignal(int)
+    progress = QtCore.pyqtSignal(dict)
     finished = QtCore.pyqtSignal(str)
     error = QtCore.pyqtSignal(str)
+    stopped = QtCore.pyqtSignal()
+    expired = QtCore.pyqtSignal()
 
-    def __init__(self, download_url, headers, cookies, video_title, quality):
+    def __init__(self, download_url, client, video_title, quality, segments=None, remux=None,
+                 transfer=None, weight=1.0):
         super().__init__()
-        self.download_url = download_url
-        self.headers = headers
-        self.cookies = cookies
-        self.video_title = video_title
-        self.quality = quality
+        self.transfer = transfer
+        self.downloader = core.create_downloader(
+            download_url,
+            client,
+            core.output_filename(video_title, quality),
+            segments or core.DEFAULT_SEGMENTS,
+            on_progress=self.report_progress,
+            remux=remux,
+            weight=weight
+        )
+
+    def cancel(self):
+        self.downloader.cancel()
+
+    def report_progress(self, stats):
+        self.progress.emit(stats)
+        if self.transfer:
+            self.transfer.progress(stats)
 
     def run(self):
         try:
-            with requests.get(self.download_url, headers=self.headers, cookies=self.cookies, stream=True) as video_response:
-                video_response.raise_for_status()
-                total_length = int(video_response.headers.get('content-length', 0))
-                downloaded = 0
-                os.makedirs("download", exist_ok=True)
-                safe_title = re.sub(r'[\\/*?:"<>|]', "", self.video_title)  # Remove illegal characters
-                filename = os.path.join("download", f"{safe_title}_{self.quality}p.mp4")
-                with open(filename, "wb") as video_file:
-                    for chunk in video_response.iter_content(chunk_size=1024):
-                        if chunk:
-                            video_file.write(chunk)
-                            downloaded += len(chunk)
-                            if total_length > 0:
-                                percent_complete = int((downloaded / total_length) * 100)
-                                self.progress.emit(percent_complete)
+            filename = self.downloader.run()
+            if self.transfer:
+                self.transfer.finish(filename)
             self.finished.emit(filename)
+        except core.DownloadCancelled:
+            self.stopped.emit()
+        except core.MediaExpired:
+            self.expired.emit()
+        except core.ResolveError as e:
+            self.fail(str(e))  # Encrypted, byte-range or empty HLS playlists
         except requests.RequestException as e:
-            self.error.emit(f"Error downloading video: {e}")
+            self.fail(f"Error downloading video: {e}")
+        except OSError as e:
+            self.fail(f"Error writing video: {e}")
+
+    def fail(self, message):
+        if self.transfer:
+            self.transfer.fail(message)
+        self.error.emit(message)
+
+class TransferListener(QtCore.QObject):
+    # Carries a shared transfer's callbacks from its worker thread to the GUI thread
+    progress = QtCore.pyqtSignal(dict)
+    finished = QtCore.pyqtSignal(str)
+    error = QtCore.pyqtSignal(str)
 
 class ImageFetchWorker(QtCore.QObject):
-    finished = QtCore.pyqtSignal(bytes)
+    finished = QtCore.pyqtSignal(QtGui.QImage)
     error = QtCore.pyqtSignal(str)
 
-    def __init__(self, image_url):
+    def __init__(self, image_url, client, height=THUMBNAIL_HEIGHT, thumbnail_cache=None):
         super().__init__()
         self.image_url = image_url
+        self.client = client
+        self.height = height
+        self.thumbnail_cache = thumbnail_cache
 
     def run(self):
+        if self.thumbnail_cache:
+            image = self.thumbnail_cache.get(self.image_url, self.height)
+            if image is not None:
+                self.finished.emit(image)
+                return
         try:
-            response = requests.get(self.image_url, stream=True)
-            response.raise_for_status()
-            image_data = response.content
-            self.finished.emit(image_data)
+            with core.metrics.stage("thumbnail", url=self.image_url) as event:
+                response = self.client.get(self.image_url)
+                event["status"] = response.status_code
+                response.raise_for_status()
+                image_data = response.content
+                event["bytes"] = len(image_data)
         except requests.RequestException as e:
             self.error.emit(f"Error fetching image: {e}")
+            return
+
+        # QImage is safe off the GUI thread, so decode and scale here
+        image = QtGui.QImage.fromData(image_data)
+        if not image.isNull():
+            image = image.scaledToHeight(self.height, QtCore.Qt.SmoothTransformation)
+            if self.thumbnail_cache:
+                self.thumbnail_cache.put(self.image_url, self.height, image)
+        self.finished.emit(image)
+
+class ThumbnailCache:
+    def __init__(self, directory, max_items=THUMBNAIL_MEMORY_ITEMS):
+        self.directory = directory
+        self.max_items = max_items
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_memory(self, image_url, height):
+        key = self.key(image_url, height)
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            return image
+
+    def get(self, image_url, height):
+        image = self.get_memory(image_url, height)
+        if image is not None:
+            return image
+        image = QtGui.QImage(self.path(image_url, height))
+        if image.isNull():
+            return None
+        self.remember(self.key(image_url, height), image)
+        return image
+
+    def put(self, image_url, height, image):
+        self.remember(self.key(image_url, height), image)
+        path = self.path(image_url, height)
+        temp_path = path + ".tmp"
+        if image.save(temp_path, "JPG", THUMBNAIL_QUALITY):
+            os.replace(temp_path, path)
+
+    def remember(self, key, image):
+        with self.lock:
+            self.images[key] = image
+            self.images.move_to_end(key)
+            while len(self.images) > self.max_items:
+                self.images.popitem(last=False)
+
+    def key(self, image_url, height):
+        return hashlib.sha1(f"{image_url}|{height}".encode("utf-8")).hexdigest()
+
+    def path(self, image_url, height):
+        return os.path.join(self.directory, self.key(image_url, height) + ".jpg")
+
+class DownloadJob(QtCore.QObject):
+    state_changed = QtCore.pyqtSignal(str)
+    task_started = QtCore.pyqtSignal(str)
+
+    def __init__(self, page_url, priority=0):
+        super().__init__()
+        self.page_url = page_url
+        self.priority = priority
+        self.state = "active"  # active, paused or cancelled
+        self.tasks = []  # Queued or running in a pool
+        self.held = []  # Waiting for resume
+
+    def has_task(self, stage):
+        return any(task.stage == stage for task in self.tasks + self.held)
+
+    def set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.state_changed.emit(state)
+
+class SchedulerTask(QtCore.QRunnable):
+    def __init__(self, job, stage, factory):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.job = job
+        self.stage = stage
+        self.factory = factory
+        self.worker = None
+        self.interrupted = False
+        self.queued_at = 0.0
+
+    def run(self):
+        core.metrics.observe(f"{self.stage}_queue", time.perf_counter() - self.queued_at, url=self.job.page_url)
+        self.job.task_started.emit(self.stage)
+        self.worker.run()
+
+class DownloadScheduler(QtCore.QObject):
+    def __init__(self, concurrency=None, parent=None):
+        super().__init__(parent)
+        self.pools = {}
+        for stage, count in dict(STAGE_CONCURRENCY, **(concurrency or {})).items():
+            pool = QtCore.QThreadPool(self)
+            pool.setMaxThreadCount(count)
+            self.pools[stage] = pool
+        self.jobs = []
+
+    def set_concurrency(self, stage, count):
+        self.pools[stage].setMaxThreadCount(max(1, count))
+
+    def submit(self, job, stage, factory):
+        if job.state == "cancelled":
+            return
+        if job not in self.jobs:
+            self.jobs.append(job)
+        task = SchedulerTask(job, stage, factory)
+        if job.state == "paused":
+            job.held.append(task)
+        else:
+            self.start(task)
+
+    def start(self, task):
+        # Workers are built on the GUI thread so their signals queue back to it
+        task.worker = task.factory()
+        for name in ("finished", "error", "stopped", "expired"):
+            signal = getattr(task.worker, name, None)
+            if signal is not None:
+                signal.connect(lambda *args, task=task: self.on_task_done(task))
+        task.job.tasks.append(task)
+        task.queued_at = time.perf_counter()
+        self.pools[task.stage].start(task, task.job.priority)
+
+    def on_task_done(self, task):
+        job = task.job
+        if task not in job.tasks:
+            return
+        job.tasks.remove(task)
+        if task.interrupted:
+            # Paused mid-run; a fresh worker picks up where this one stopped
+            if job.state == "paused":
+                job.held.append(task)
+            elif job.state == "active":
+                task.interrupted = False
+                self.start(task)
+        if not job.tasks and not job.held and job in self.jobs:
+            self.jobs.remove(job)
+
+    def pause(self, job):
+        if job.state != "active":
+            return
+        job.set_state("paused")
+        for task in list(job.tasks):
+            if self.pools[task.stage].tryTake(task):
+                job.tasks.remove(task)
+                job.held.append(task)
+            elif hasattr(task.worker, "cancel"):
+                task.interrupted = True
+                task.worker.cancel()
+
+    def resume(self, job):
+        if job.state != "paused":
+            return
+        job.set_state("active")
+        held, job.held = job.held, []
+        for task in held:
+            task.interrupted = False
+            self.start(task)
+
+    def cancel(self, job):
+        if job.state == "cancelled":
+            return
+        job.set_state("cancelled")
+        job.held = []
+        for task in list(job.tasks):
+            if self.pools[task.stage].tryTake(task):
+                job.tasks.remove(task)
+            elif hasattr(task.worker, "cancel"):
+                task.worker.cancel()
+        if not job.tasks and job in self.jobs:
+            self.jobs.remove(job)
+
+    def set_priority(self, job, priority):
+        job.priority = priority
+        for task in list(job.tasks):
+            if self.pools[task.stage].tryTake(task):
+                job.tasks.remove(task)
+                self.start(task)
+
+    def shutdown(self):
+        for job in list(self.jobs):
+            self.cancel(job)
+        for pool in self.pools.values():
+            pool.waitForDone(SHUTDOWN_TIMEOUT_MS)
 
 class MainWindow(QtWidgets.QMainWindow):
+    first_painted = QtCore.pyqtSignal()
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("DownloadHub")
         self.setGeometry(200, 200, 800, 600)
+        self.painted = False
+        self.client = None
         self.init_ui()
 
-        self.cookies = {
-            "__l": "65FC75EF-42FE722901BB121A2D-9ECE1D",
-            "__s": "6728CC3F-42FE722901BB876CE-1C075",
-            "_ga": "GA1.1.1777442377.1730726996",
-            "_ga_B39RFFWGYY": "GS1.1.1730726996.1.1.1730728319.59.0.0",
-            "accessAgeDisclaimerPH": "1",
-            "bs": "t6w44rd46bdjdh6nknndp2d0l8smghep",
-            "bsdd": "t6w44rd46bdjdh6nknndp2d0l8smghep",
-            "cookieConsent": "3",
-            "entryOrigin": "VidPg-premVid",
-            "etavt": "%7B%2266385e0dc12af%22%3A%221_24_2_NA%7C1%22%2C%22662c2f84c2f33%22%3A%225_2_2_pornhub.related_video.96%7C0%22%7D",
-            "fg_afaf12e314c5419a855ddc0bf120670f": "27930.100000",
-            "htjf-mobile": "1",
-            "lvv": "984390804839735301",
-            "platform": "pc",
-            "sessid": "101750858070270346",
-            "ss": "500721751518614168",
-            "ua": "c255ff0d5d20335c36999a538b820aaa",
-            "views": "6",
-            "vlc": "168270359546915842",
-        }
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.painted:
+            self.painted = True
+            # Let this frame reach the screen before the slower start-up work runs
+            QtCore.QTimer.singleShot(0, self.first_painted.emit)
 
-        self.headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                          "AppleWebKit/537.36 (KHTML, like Gecko) "
-                          "Chrome/92.0.4515.159 Safari/537.36",
-            'Accept': 'application/json, text/javascript, */*; q=0.01'
-        }
+    def start_services(self):
+        # Network, caches and the saved list come up after the first paint, or sooner if the user gets there first
+        if self.client:
+            return
+        self.cookies = dict(core.DEFAULT_COOKIES)
+        self.headers = dict(core.DEFAULT_HEADERS)
+        self.client = core.HttpClient(self.headers, self.cookies, limiter=core.BandwidthLimiter())
+        self.scheduler = DownloadScheduler()
+        self.metadata_cache = core.MetadataCache(os.path.join(core.CACHE_DIR, "metadata.sqlite3"))
+        self.thumbnail_cache = ThumbnailCache(os.path.join(core.CACHE_DIR, "thumbnails"))
+        self.download_index = core.DownloadIndex(os.path.join(core.CACHE_DIR, "downloads.sqlite3"))
+        self.queued_keys = set()
+        self.on_limit_changed(self.limit_combo.currentText())
+
+        # The list is saved as it changes and comes back on the next start
+        self.session = core.SessionStore(os.path.join(core.CACHE_DIR, "session.sqlite3"))
+        self.session_timer = QtCore.QTimer(self)
+        self.session_timer.timeout.connect(self.session.flush)
+        self.session_timer.start(SESSION_FLUSH_MS)
+        self.restore_queue = deque()
+        self.restore_timer = QtCore.QTimer(self)
+        self.restore_timer.timeout.connect(self.restore_next)
+        self.restore_session()
+
+    def restore_session(self):
+        # Rows come back from disk alone, resolving and resuming trickle in through restore_next
+        for entry in self.session.load():
+            self.queued_keys.add(core.cache_key(entry["page_url"]))
+            item = self.create_item(entry["page_url"], entry=entry)
+            if entry["state"] in ("queued", "downloading"):
+                self.restore_queue.append(item)
+        if self.restore_queue:
+            self.restore_timer.start(RESTORE_INTERVAL_MS)
+
+    def restore_next(self):
+        restored = 0
+        while self.restore_queue and restored < RESTORE_PER_TICK:
+            item = self.restore_queue.popleft()
+            if item.pending_restore and item.job.state == "active":
+                item.restore()
+                restored += 1
+        if not self.restore_queue:
+            self.restore_timer.stop()
+
+    def on_limit_changed(self, text):
+        if not self.client:
+            return  # Applied once the services start
+        if text.strip().lower() in ("", "unlimited"):
+            self.client.limiter.set_rate(0)
+            return
+        try:
+            self.client.limiter.set_rate(core.parse_rate(text))
+        except ValueError:
+            pass  # Keep the old cap while the user is still typing
+
+    def current_policy(self):
+        try:
+            return core.parse_quality_policy(self.policy_combo.currentText())
+        except ValueError:
+            return None  # Manual, or something that is not a policy
+
+    def toggle_debug_panel(self):
+        # Live stage latencies and throughput, also kept as a Prometheus textfile
+        self.start_services()
+        visible = not self.debug_panel.isVisible()
+        self.debug_panel.setVisible(visible)
+        if visible:
+            self.last_debug_bytes = core.metrics.snapshot()["transferred_bytes"]
+            self.last_debug_time = time.monotonic()
+            self.debug_timer.start(DEBUG_REFRESH_MS)
+        else:
+            self.debug_timer.stop()
+
+    def refresh_debug_panel(self):
+        snapshot = core.metrics.snapshot()
+        now = time.monotonic()
+        throughput = (snapshot["transferred_bytes"] - self.last_debug_bytes) / max(now - self.last_debug_time, 1e-6)
+        self.last_debug_bytes, self.last_debug_time = snapshot["transferred_bytes"], now
+        lines = core.format_metrics(snapshot, throughput)
+        for item in self.client.limiter.report()["items"]:
+            allotted = f"{core.format_size(item['allotted'])}/s" if item["allotted"] else "unlimited"
+            lines.append(f"{item['name']}: {core.format_size(item['actual'])}/s of {allotted}")
+        self.debug_panel.setPlainText("\n".join(lines))
+        try:
+            core.metrics.write_prometheus(os.path.join(core.CACHE_DIR, "metrics.prom"))
+        except OSError:
+            pass
+
+    def closeEvent(self, event):
+        self.debug_timer.stop()
+        if self.client:
+            self.restore_timer.stop()
+            self.session_timer.stop()
+            # Saved as they are now; the cancels from shutdown are not the user's and must not be stored
+            for item in self.download_model.items:
+                item.session = None
+            self.session.close()
+            self.scheduler.shutdown()
+            self.client.close()
+            self.metadata_cache.close()
+            self.download_index.close()
+        super().closeEvent(event)
 
     def init_ui(self):
         central_widget = QtWidgets.QWidget()
@@ -474,11 +1139,54 @@ class MainWindow(QtWidgets.QMainWindow):
         url_layout.setSpacing(10)
 
         self.url_input = QtWidgets.QLineEdit(self)
-        self.url_input.setPlaceholderText("Enter video URL")
+        self.url_input.setPlaceholderText("Enter a video, playlist, model or channel URL")
         self.url_input.setMinimumHeight(30)
         self.url_input.setFont(QtGui.QFont("Poppins Medium", 10))
         url_layout.addWidget(self.url_input)
 
+        self.remux_combo = QtWidgets.QComboBox(self)
+        self.remux_combo.setFixedHeight(30)
+        self.remux_combo.setFont(QtGui.QFont("Poppins Medium", 10))
+        self.remux_combo.addItem("Original", None)
+        self.remux_combo.addItem("MP4 (faststart)", "mp4")
+        self.remux_combo.addItem("MKV", "mkv")
+        self.remux_combo.setToolTip("Remux downloads with ffmpeg while they stream in")
+        url_layout.addWidget(self.remux_combo)
+
+        # Connections per new download, 0 leaves it to core.DEFAULT_SEGMENTS like cli.py's -s
+        self.segments_spin = QtWidgets.QSpinBox(self)
+        self.segments_spin.setFixedHeight(30)
+        self.segments_spin.setFont(QtGui.QFont("Poppins Medium", 10))
+        self.segments_spin.setRange(0, MAX_SEGMENTS)
+        self.segments_spin.setSpecialValueText("Auto")
+        self.segments_spin.setToolTip("Connections per download, for servers that support byte ranges")
+        url_layout.addWidget(self.segments_spin)
+
+        # Shared bandwidth cap, type a rate such as 3M or pick one; applies to running downloads too
+        self.limit_combo = QtWidgets.QComboBox(self)
+        self.limit_combo.setEditable(True)
+        self.limit_combo.setFixedHeight(30)
+        self.limit_combo.setFont(QtGui.QFont("Poppins Medium", 10))
+        self.limit_combo.addItems(["Unlimited", "1M", "5M", "10M", "50M"])
+        self.limit_combo.setToolTip("Bandwidth cap for all downloads together, in bytes per second")
+        self.limit_combo.currentTextChanged.connect(self.on_limit_changed)
+        url_layout.addWidget(self.limit_combo)
+
+        # Auto-select queues the download as soon as the qualities are known; Manual waits for a click
+        self.policy_combo = QtWidgets.QComboBox(self)
+        self.policy_combo.setEditable(True)
+        self.policy_combo.setFixedHeight(30)
+        self.policy_combo.setFont(QtGui.QFont("Poppins Medium", 10))
+        self.policy_combo.addItems(["Manual", "Best", "1080p", "720p", "480p", "500M"])
+        self.policy_combo.setToolTip("Pick a quality automatically: best, at most a height, or at most a file size")
+        url_layout.addWidget(self.policy_combo)
+
+        self.refresh_checkbox = QtWidgets.QCheckBox("Refresh expired", self)
+        self.refresh_checkbox.setFont(QtGui.QFont("Poppins Medium", 10))
+        self.refresh_checkbox.setChecked(True)
+        self.refresh_checkbox.setToolTip("Fetch new signed links when they expire mid-download and resume")
+        url_layout.addWidget(self.refresh_checkbox)
+
         self.add_button = QtWidgets.QPushButton("Add", self)
         self.add_button.setFixedHeight(30)
         self.add_button.setFont(QtGui.QFont("Poppins Medium", 10))
@@ -487,18 +1195,34 @@ class MainWindow(QtWidgets.QMainWindow):
 
         main_layout.addLayout(url_layout)
 
-        # Scroll Area for Download Items
-        self.scroll_area = QtWidgets.QScrollArea(self)
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.setStyleSheet("background-color: #121212;")
-
-        self.download_list_widget = QtWidgets.QWidget()
-        self.download_list_layout = QtWidgets.QVBoxLayout()
-        self.download_list_layout.setAlignment(QtCore.Qt.AlignTop)
-        self.download_list_widget.setLayout(self.download_list_layout)
-
-        self.scroll_area.setWidget(self.download_list_widget)
-        main_layout.addWidget(self.scroll_area)
+        # Download list, only the visible rows are painted
+        self.download_model = DownloadListModel(self)
+        self.download_delegate = DownloadItemDelegate(self)
+        self.download_delegate.action_triggered.connect(self.on_item_action)
+        self.download_delegate.thumbnail_needed.connect(self.on_thumbnail_needed, QtCore.Qt.QueuedConnection)
+
+        self.download_list_view = QtWidgets.QListView(self)
+        self.download_list_view.setModel(self.download_model)
+        self.download_list_view.setItemDelegate(self.download_delegate)
+        self.download_list_view.setUniformItemSizes(True)
+        self.download_list_view.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.download_list_view.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.download_list_view.setFocusPolicy(QtCore.Qt.NoFocus)
+        main_layout.addWidget(self.download_list_view)
+
+        # Debug panel, F12 shows or hides it
+        self.debug_panel = QtWidgets.QPlainTextEdit(self)
+        self.debug_panel.setReadOnly(True)
+        self.debug_panel.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.debug_panel.setFixedHeight(160)
+        self.debug_panel.hide()
+        main_layout.addWidget(self.debug_panel)
+
+        self.debug_timer = QtCore.QTimer(self)
+        self.debug_timer.timeout.connect(self.refresh_debug_panel)
+        self.last_debug_bytes = 0
+        self.last_debug_time = 0.0
+        QtWidgets.QShortcut(QtGui.QKeySequence("F12"), self, activated=self.toggle_debug_panel)
 
         central_widget.setLayout(main_layout)
 
@@ -535,9 +1259,32 @@ class MainWindow(QtWidgets.QMainWindow):
             QPushButton:disabled {
                 background-color: #666666;
             }
-            QScrollArea {
+            QComboBox, QSpinBox {
+                padding: 5px;
+                border: 2px solid #FFA500;
+                border-radius: 5px;
+                background-color: #1E1E1E;
+                color: #FFFFFF;
+                font-family: "Poppins";
+                font-weight: 500;
+            }
+            QListView {
+                background-color: #121212;
                 border: none;
             }
+            QPlainTextEdit {
+                background-color: #1E1E1E;
+                color: #FFA500;
+                border: 1px solid #444444;
+            }
+            QMenu {
+                background-color: #1E1E1E;
+                border: 1px solid #FFA500;
+            }
+            QMenu::item:selected {
+                background-color: #FFA500;
+                color: #1B1B1B;
+            }
         """)
 
     def add_download_item(self):
@@ -546,51 +1293,124 @@ class MainWindow(QtWidgets.QMainWindow):
             QtWidgets.QMessageBox.warning(self, "Input Error", "Please enter a valid URL.")
             return
 
-        download_item = DownloadItem(page_url, self.headers, self.cookies, self)
-        self.download_list_layout.addWidget(download_item)
+        self.start_services()
+        if core.is_listing_url(page_url):
+            self.expand_listing(page_url)
+        elif not self.queue_video(page_url):
+            self.statusBar().showMessage("That video is already in the list.", STATUS_MESSAGE_MS)
         self.url_input.clear()
 
-def main():
-    app = QtWidgets.QApplication(sys.argv)
+    def expand_listing(self, listing_url):
+        # The crawl runs in the background and fills the list page by page
+        job = DownloadJob(listing_url)
+        counts = {"added": 0, "duplicates": 0}
+
+        def on_found(video_urls):
+            for video_url in video_urls:
+                counts["added" if self.queue_video(video_url) else "duplicates"] += 1
+            self.statusBar().showMessage(
+                f"Expanding {listing_url}: {counts['added']} added, {counts['duplicates']} duplicates skipped"
+            )
+
+        def on_finished(found):
+            self.statusBar().showMessage(
+                f"Expanded {listing_url}: {counts['added']} added, {counts['duplicates']} duplicates skipped",
+                STATUS_MESSAGE_MS
+            )
+
+        def on_error(message):
+            self.statusBar().showMessage(f"Could not expand {listing_url}: {message}", STATUS_MESSAGE_MS)
+
+        def create_listing_worker():
+            worker = ListingWorker(listing_url, self.client)
+            worker.found.connect(on_found)
+            worker.finished.connect(on_finished)
+            worker.error.connect(on_error)
+            return worker
+
+        self.statusBar().showMessage(f"Expanding {listing_url}...")
+        self.scheduler.submit(job, "listing", create_listing_worker)
+
+    def queue_video(self, page_url):
+        # Repeats are dropped here, before any FindWorker is spent on them
+        key = core.cache_key(page_url)
+        if key in self.queued_keys:
+            return False
+        self.queued_keys.add(key)
+        self.create_item(page_url)
+        return True
+
+    def create_item(self, page_url, entry=None):
+        return DownloadItem(
+            page_url,
+            self.client,
+            self.scheduler,
+            self.download_model,
+            metadata_cache=self.metadata_cache,
+            thumbnail_cache=self.thumbnail_cache,
+            download_index=self.download_index,
+            segments=self.segments_spin.value() or None,
+            remux=self.remux_combo.currentData(),
+            refresh_expired=self.refresh_checkbox.isChecked(),
+            # Restored items keep waiting for a click if they were; the policy is for new ones
+            policy=None if entry else self.current_policy(),
+            session=self.session,
+            entry=entry,
+            parent=self
+        )
 
-    # Load the Poppins fonts with desired weights
-    from PyQt5.QtGui import QFontDatabase, QFont
-
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    fonts_dir = os.path.join(script_dir, 'fonts')
-
-    # List of Poppins font files to load
-    font_files = [
-        'Poppins-Regular.ttf',    # Weight 400
-        'Poppins-Medium.ttf',     # Weight 500
-        'Poppins-SemiBold.ttf'    # Weight 600
-    ]
-
-    loaded_fonts = []
-    for font_file in font_files:
-        font_path = os.path.join(fonts_dir, font_file)
-        if os.path.exists(font_path):
-            font_id = QFontDatabase.addApplicationFont(font_path)
-            if font_id != -1:
-                family = QFontDatabase.applicationFontFamilies(font_id)[0]
-                loaded_fonts.append(family)
-                print(f"Loaded font: {family}")
-            else:
-                print(f"Failed to load font: {font_file}")
+    def on_item_action(self, row, action, position):
+        item = self.download_model.items[row]
+        if action == "quality":
+            menu = QtWidgets.QMenu(self)
+            for index, label in enumerate(item.record.quality_labels):
+                menu.addAction(label, lambda index=index: item.on_quality_selected(index))
+            menu.exec_(position)
+        elif action == "download":
+            item.download_video()
+        elif action == "pause":
+            item.toggle_pause()
+        elif action == "cancel":
+            item.cancel()
+
+    def on_thumbnail_needed(self, row):
+        self.download_model.items[row].request_thumbnail()
+
+def load_fonts(app):
+    # Only the weights the UI uses; until they are in, the window paints with the system font
+    fonts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+    loaded = False
+    for font_file in FONT_FILES:
+        if QtGui.QFontDatabase.addApplicationFont(os.path.join(fonts_dir, font_file)) == -1:
+            print(f"Could not load font: {font_file}", file=sys.stderr)
         else:
-            print(f"Font file not found: {font_file}")
-
-    if not loaded_fonts:
-        print("No fonts loaded. Please check the font files.")
-    else:
-        # Set the default application font to Poppins with desired weight
-        # Choose the desired weight: 500 (Medium) or 600 (SemiBold)
-        # For example, using SemiBold
-        app.setFont(QFont("Poppins SemiBold", 10))
-        print("Poppins SemiBold font loaded and set as default.")
+            loaded = True
+    if loaded:
+        app.setFont(QtGui.QFont("Poppins SemiBold", 10))
 
+def main():
+    app = QtWidgets.QApplication(sys.argv)
     window = MainWindow()
+    # Start-up timings for benchmarks/bench_startup.py, which reads them from stdout
+    trace = os.environ.get(STARTUP_TRACE_ENV)
+    marks = {}
+
+    def report():
+        marks["interactive"] = time.monotonic()
+        print(json.dumps(marks), flush=True)
+        window.close()
+
+    def start():
+        marks["first_paint"] = time.monotonic()
+        load_fonts(app)
+        window.start_services()
+        if trace:
+            # Interactive once the event loop is idle again with everything loaded
+            QtCore.QTimer.singleShot(0, report)
+
+    window.first_painted.connect(start)
     window.show()
+    marks["shown"] = time.monotonic()
     sys.exit(app.exec_())
 
 if __name__ == "__main__":